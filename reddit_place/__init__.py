@@ -64,17 +64,38 @@ class Place(Plugin):
     }
 
     config = {
-        # TODO: your static configuratation options go here, e.g.:
-        # ConfigValue.int: [
-        #     "place_blargs",
-        # ],
+        ConfigValue.bool: [
+            "place_tiled_storage",
+            "place_compact_columns",
+            "place_write_behind",
+        ],
+        ConfigValue.int: [
+            "place_snapshot_interval",
+            "place_broadcast_interval_ms",
+            "place_activity_max_age",
+        ],
+        ConfigValue.str: [
+            "place_canvas_layout",
+            "place_snapshot_dir",
+        ],
     }
 
     live_config = {
-        # TODO: your live configuratation options go here, e.g.:
-        # ConfigValue.int: [
-        #     "place_realtime_blargs",
-        # ],
+        ConfigValue.bool: [
+            "place_binary_broadcasts",
+            "place_degraded",
+            "place_circuit_breaker",
+        ],
+        ConfigValue.int: [
+            "place_breaker_slow_ms",
+        ],
+        ConfigValue.str: [
+            "place_board_format",
+        ],
+        ConfigValue.float: [
+            "place_stage_sample_rate",
+            "place_breaker_error_rate",
+        ],
     }
 
     errors = {
@@ -91,6 +112,17 @@ class Place(Plugin):
            conditions={"function": not_in_sr})
         mc("/api/place/board-bitmap", controller="loggedoutplace",
            action="board_bitmap", conditions={"function": not_in_sr})
+        # the extension middleware may already have stripped the ".png".
+        mc("/api/place/board.png", controller="loggedoutplace",
+           action="board_png", conditions={"function": not_in_sr})
+        mc("/api/place/board", controller="loggedoutplace",
+           action="board_png", conditions={"function": not_in_sr})
+        mc("/api/place/board-tile", controller="loggedoutplace",
+           action="board_tile", conditions={"function": not_in_sr})
+        mc("/api/place/board-delta", controller="loggedoutplace",
+           action="board_delta", conditions={"function": not_in_sr})
+        mc("/api/place/board-history", controller="place",
+           action="board_history", conditions={"function": not_in_sr})
 
         mc("/api/place/:action", controller="place",
            conditions={"function": not_in_sr})
@@ -107,14 +139,11 @@ class Place(Plugin):
         Reddit.extra_stylesheets.append('place_global.less')
 
     def declare_queues(self, queues):
-        # TODO: add any queues / bindings you need here, e.g.:
-        #
-        # queues.some_queue_defined_elsewhere << "routing_key"
-        #
-        # or
-        #
-        # from r2.config.queues import MessageQueue
-        # queues.declare({
-        #     "some_q": MessageQueue(),
-        # })
-        pass
+        from r2.config.queues import MessageQueue
+        from reddit_place.broadcast import BROADCAST_QUEUE
+        from reddit_place.models import PIXEL_WRITE_QUEUE
+
+        queues.declare({
+            BROADCAST_QUEUE: MessageQueue(bind_to_self=True),
+            PIXEL_WRITE_QUEUE: MessageQueue(bind_to_self=True),
+        })
@@ -1,12 +1,19 @@
 from r2.lib import amqp, baseplate_integration, websockets
 
-from reddit_place.controllers import get_activity_count, ActivityError
+from reddit_place.controllers import (
+    ActivityError,
+    cache_activity_count,
+    compute_activity_count,
+)
 
 
 @baseplate_integration.with_root_span("job.place_activity")
 def broadcast_activity():
     try:
-        activity = get_activity_count()
+        activity = compute_activity_count()
+        # share the count with request handlers so they don't each have to
+        # compute it again.
+        cache_activity_count(activity)
         websockets.send_broadcast(
             namespace="/place",
             type="activity",
@@ -0,0 +1,499 @@
+"""
+In-process stand-ins for the services place talks to.
+
+Each fake keeps its data in memory and sleeps for a configurable latency per
+round trip, so the cost of the code under test and the number of round
+trips it makes both show up in the numbers.
+
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import bisect
+import random
+import time
+import uuid
+
+from pylons import app_globals as g
+from pylons import tmpl_context as c
+
+from r2.lib.db import tdb_cassandra
+from r2.lib.utils import to36
+
+from reddit_place import models
+
+
+class Latency(object):
+    """How long a round trip to a fake service takes.
+
+    Most calls take `median` seconds, and `tail_rate` of them take `tail`
+    seconds instead.
+
+    """
+
+    def __init__(self, median=0, tail=None, tail_rate=0.01, seed=0):
+        self.median = median
+        self.tail = median if tail is None else tail
+        self.tail_rate = tail_rate
+        self.round_trips = 0
+        self._random = random.Random(seed)
+
+    @classmethod
+    def from_ms(cls, median_ms=0, tail_ms=None, tail_rate=0.01):
+        return cls(
+            median_ms / 1000.,
+            None if tail_ms is None else tail_ms / 1000.,
+            tail_rate,
+        )
+
+    def wait(self):
+        self.round_trips += 1
+        if self._random.random() < self.tail_rate:
+            delay = self.tail
+        else:
+            delay = self.median
+        if delay:
+            time.sleep(delay)
+
+
+class FakeRedis(object):
+    """Enough of a redis-py client for what place uses, BITFIELD included."""
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.strings = {}
+        self.zsets = {}
+        self.expires = {}
+
+    # the commands, without any latency
+
+    def _get(self, key):
+        self._check_expiry(key)
+        return self.strings.get(key)
+
+    def _check_expiry(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.strings.pop(key, None)
+            self.zsets.pop(key, None)
+            del self.expires[key]
+
+    def _set(self, key, value, ex=None, nx=False):
+        self._check_expiry(key)
+        if nx and key in self.strings:
+            return None
+        # redis-py sends floats with repr, so they keep their precision.
+        self.strings[key] = repr(value) if isinstance(value, float) \
+            else str(value)
+        if ex:
+            self.expires[key] = time.time() + ex
+        else:
+            self.expires.pop(key, None)
+        return True
+
+    def _mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def _mset(self, mapping):
+        for key, value in mapping.iteritems():
+            self._set(key, value)
+        return True
+
+    def _incr(self, key, amount=1):
+        value = int(self._get(key) or 0) + amount
+        self.strings[key] = str(value)
+        return value
+
+    def _setrange(self, key, offset, value):
+        current = self._get(key) or ''
+        current = current.ljust(offset, '\x00')
+        self.strings[key] = current[:offset] + value + \
+            current[offset + len(value):]
+        return len(self.strings[key])
+
+    def _getrange(self, key, start, end):
+        return (self._get(key) or '')[start:end + 1]
+
+    def _bitfield(self, key, *ops):
+        # only SET on u4 with a #offset is supported, which is all we send.
+        bitmap = bytearray(self._get(key) or '')
+        results = []
+        for i in xrange(0, len(ops), 4):
+            op, size, offset, value = ops[i:i + 4]
+            if op.upper() != 'SET' or size != 'u4' or offset[0] != '#':
+                raise NotImplementedError("BITFIELD %s %s %s" % ops[i:i + 3])
+
+            offset = int(offset[1:])
+            value = int(value)
+            idx = offset / 2
+            if idx >= len(bitmap):
+                bitmap.extend('\x00' * (idx + 1 - len(bitmap)))
+
+            if offset % 2:
+                results.append(bitmap[idx] & 15)
+                bitmap[idx] = (bitmap[idx] & 0xF0) | value
+            else:
+                results.append(bitmap[idx] >> 4)
+                bitmap[idx] = (bitmap[idx] & 0x0F) | (value << 4)
+        self.strings[key] = str(bitmap)
+        return results
+
+    def _zset(self, key):
+        self._check_expiry(key)
+        return self.zsets.setdefault(key, ([], {}))
+
+    def _zadd(self, key, *args):
+        entries, scores = self._zset(key)
+        added = 0
+        for i in xrange(0, len(args), 2):
+            score, member = float(args[i]), args[i + 1]
+            if member in scores:
+                entries.remove((scores[member], member))
+            else:
+                added += 1
+            scores[member] = score
+            bisect.insort(entries, (score, member))
+        return added
+
+    def _zcard(self, key):
+        return len(self._zset(key)[0])
+
+    def _zrange(self, key, start, end, withscores=False):
+        entries = self._zset(key)[0]
+        end = len(entries) if end == -1 else end + 1
+        selected = entries[start:end]
+        if withscores:
+            return [(member, score) for score, member in selected]
+        return [member for score, member in selected]
+
+    def _zrangebyscore(self, key, low, high):
+        entries = self._zset(key)[0]
+        low = float(low)
+        high = float(high)
+        return [member for score, member in entries if low <= score <= high]
+
+    def _zremrangebyrank(self, key, start, end):
+        entries, scores = self._zset(key)
+        if end < 0:
+            end = len(entries) + end
+        removed = entries[start:end + 1]
+        del entries[start:end + 1]
+        for score, member in removed:
+            del scores[member]
+        return len(removed)
+
+    def _execute_command(self, name, *args):
+        return getattr(self, "_" + name.lower())(*args)
+
+    def _run_script(self, script, keys, args):
+        if script == models.RedisPlacement.SCRIPT:
+            return self._place(keys, args)
+        raise NotImplementedError("unknown script")
+
+    def _place(self, keys, args):
+        # RedisPlacement.SCRIPT, in python.
+        cooldown_key, canvas_key, changes_key, generation_key = keys
+        (now, min_interval, cooldown, ttl, offset, color, packed,
+            max_length) = args
+        now = float(now)
+
+        previous = self._get(cooldown_key)
+        if previous is None:
+            return [-1]
+        previous = float(previous)
+        if previous + min_interval > now:
+            return [0, repr(previous + cooldown - now)]
+
+        self._bitfield(canvas_key, 'SET', 'u4', '#%d' % offset, color)
+        self._zadd(changes_key, now, packed)
+        self._zremrangebyrank(changes_key, 0, -(max_length + 1))
+        self._set(cooldown_key, now, ex=ttl)
+        return [1, self._incr(generation_key)]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        # each command on the client is a round trip of its own.
+        command = getattr(self, "_" + name)
+
+        def round_trip(*args, **kwargs):
+            self.latency.wait()
+            return command(*args, **kwargs)
+        return round_trip
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return FakeScript(self, script)
+
+
+class FakePipeline(object):
+    """Queues up commands and runs them all in one round trip."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        command = getattr(self.redis, "_" + name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.redis.latency.wait()
+        results = [
+            command(*args, **kwargs)
+            for command, args, kwargs in self.commands
+        ]
+        self.commands = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+
+class FakeScript(object):
+    def __init__(self, redis, script):
+        self.redis = redis
+        self.script = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        redis = client or self.redis
+        redis.latency.wait()
+        return redis._run_script(self.script, keys, args)
+
+
+def _column_key(column):
+    # TimeUUID columns sort by time, like the TimeUUIDType comparator.
+    if isinstance(column, uuid.UUID):
+        return (column.time, column.bytes)
+    return column
+
+
+def _in_slice(key, start, finish):
+    if start not in ('', None) and key < _column_key(start):
+        return False
+    if finish not in ('', None):
+        finish = _column_key(finish)
+        if isinstance(finish, tuple) and isinstance(key, tuple):
+            # a composite prefix includes every column that starts with it.
+            key = key[:len(finish)]
+        if key > finish:
+            return False
+    return True
+
+
+class FakeColumnFamily(object):
+    """Enough of a pycassa ColumnFamily for the views place uses.
+
+    Writes keep the column with the newest timestamp, as in cassandra.
+
+    """
+
+    pool = None
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.rows = {}
+
+    def _insert(self, key, columns, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time() * 1000000)
+        row = self.rows.setdefault(key, {})
+        for column, value in columns.iteritems():
+            existing = row.get(column)
+            if existing is None or existing[1] <= timestamp:
+                row[column] = (value, timestamp)
+
+    def _slice(self, key, columns=None, column_start='', column_finish='',
+               column_count=100, column_reversed=False,
+               include_timestamp=False):
+        row = self.rows.get(key)
+        if not row:
+            return None
+
+        def cell(column):
+            value, timestamp = row[column]
+            return (value, timestamp) if include_timestamp else value
+
+        if columns is not None:
+            return [(column, cell(column))
+                    for column in columns if column in row]
+
+        if column_reversed:
+            column_start, column_finish = column_finish, column_start
+
+        selected = sorted(
+            (_column_key(column), column, cell(column))
+            for column in row
+            if _in_slice(_column_key(column), column_start, column_finish)
+        )
+        if column_reversed:
+            selected.reverse()
+        return [(column, value) for _, column, value in selected][:column_count]
+
+    def insert(self, key, columns, timestamp=None):
+        self.latency.wait()
+        self._insert(key, columns, timestamp)
+
+    def get(self, key, **kwargs):
+        self.latency.wait()
+        selected = self._slice(key, **kwargs)
+        if not selected:
+            raise tdb_cassandra.NotFoundException()
+        return OrderedDict(selected)
+
+    def multiget(self, keys, **kwargs):
+        self.latency.wait()
+        rows = OrderedDict()
+        for key in keys:
+            selected = self._slice(key, **kwargs)
+            if selected:
+                rows[key] = OrderedDict(selected)
+        return rows
+
+    def xget(self, key, column_start='', column_finish='',
+             buffer_size=1024, **kwargs):
+        selected = self._slice(
+            key, column_start=column_start, column_finish=column_finish,
+            column_count=None, **kwargs)
+        if not selected:
+            raise tdb_cassandra.NotFoundException()
+
+        for i in xrange(0, len(selected), buffer_size):
+            self.latency.wait()
+            for column in selected[i:i + buffer_size]:
+                yield column
+
+
+class FakeMutator(object):
+    """A pycassa Mutator that writes to FakeColumnFamilys."""
+
+    def __init__(self, pool, queue_size=100, write_consistency_level=None):
+        self.mutations = []
+
+    def insert(self, column_family, key, columns, timestamp=None, ttl=None):
+        self.mutations.append((column_family, key, columns, timestamp))
+
+    def send(self):
+        if not self.mutations:
+            return
+
+        # the whole batch is one round trip.
+        self.mutations[0][0].latency.wait()
+        for column_family, key, columns, timestamp in self.mutations:
+            column_family._insert(key, columns, timestamp)
+        self.mutations = []
+
+
+class FakeCache(object):
+    """A memcache client with no latency, for g.cache."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value, time=0, noreply=False):
+        self.values[key] = value
+
+    def get_multi(self, keys, prefix=''):
+        return {
+            key: self.values[prefix + key]
+            for key in keys if prefix + key in self.values
+        }
+
+    def set_multi(self, mapping, prefix='', time=0):
+        for key, value in mapping.iteritems():
+            self.values[prefix + key] = value
+
+    def delete_multi(self, keys, prefix=''):
+        for key in keys:
+            self.values.pop(prefix + key, None)
+
+
+class FakeUser(object):
+    def __init__(self, user_id):
+        self._id = user_id
+        self.name = "user%d" % user_id
+        self._fullname = "t2_%s" % to36(user_id)
+
+
+# The views that get a fake column family.
+VIEWS = (
+    models.Pixel,
+    models.PixelsByParticipant,
+    models.Canvas,
+    models.BoardChanges,
+    models.BoardKeyframe,
+    models.BoardKeyframesByTime,
+    models.PlaceUsernames,
+)
+
+
+@contextmanager
+def fake_backends(redis_latency=None, cass_latency=None, config=None):
+    """Point place at fakes for redis, cassandra and memcache.
+
+    `config` is a dict of place settings on `g` to use for the duration,
+    e.g. {"place_tiled_storage": True}.  Yields a dict of the fakes.
+
+    """
+
+    cass_latency = cass_latency or Latency()
+    fakes = {
+        "redis": FakeRedis(redis_latency),
+        "cache": FakeCache(),
+        "cfs": {view: FakeColumnFamily(cass_latency) for view in VIEWS},
+    }
+
+    missing = object()
+    saved_config = {}
+    for name, value in (config or {}).iteritems():
+        saved_config[name] = getattr(g, name, missing)
+        setattr(g, name, value)
+
+    saved_cfs = {view: view.__dict__.get("_cf", missing) for view in VIEWS}
+    saved = (
+        getattr(c, "place_redis", None),
+        g.cache,
+        g.stalecache,
+        models.Mutator,
+        models.RedisPlacement._script,
+    )
+
+    c.place_redis = fakes["redis"]
+    g.cache = fakes["cache"]
+    g.stalecache = None
+    models.Mutator = FakeMutator
+    models.RedisPlacement._script = None
+    for view, cf in fakes["cfs"].iteritems():
+        view._cf = cf
+
+    try:
+        yield fakes
+    finally:
+        (c.place_redis, g.cache, g.stalecache, models.Mutator,
+            models.RedisPlacement._script) = saved
+        for view, cf in saved_cfs.iteritems():
+            if cf is missing:
+                del view._cf
+            else:
+                view._cf = cf
+        for name, value in saved_config.iteritems():
+            if value is missing:
+                delattr(g, name)
+            else:
+                setattr(g, name, value)
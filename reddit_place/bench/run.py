@@ -0,0 +1,269 @@
+"""
+Benchmarks for the place hot paths, run against the fakes.
+
+Run them from a shell on a dev VM, no redis or cassandra needed:
+
+    paster run $REDDIT_INI -c 'from reddit_place.bench.run import main; main()'
+
+"""
+
+from collections import OrderedDict
+import gc
+import itertools
+import json
+import random
+import resource
+import time
+import uuid
+
+from pylons import tmpl_context as c
+
+from reddit_place import lib
+from reddit_place.bench.fakes import fake_backends, FakeUser, Latency
+from reddit_place.board_formats import BOARD_BITMAP_CACHE, get_board_bitmap
+from reddit_place.models import (
+    ADMIN_RECT_DRAW_MAX_SIZE,
+    CANVAS_BITMAP_SIZE,
+    CANVAS_HEIGHT,
+    CANVAS_WIDTH,
+    Canvas,
+    get_wait_seconds,
+    Pixel,
+    PIXEL_COOLDOWN_SECONDS,
+    place_pixel,
+    RedisCanvas,
+    RedisCooldown,
+)
+
+# name -> (setup function, default iterations)
+SCENARIOS = OrderedDict()
+
+
+def scenario(name, iterations):
+    """Register a scenario.
+
+    The decorated function is called with the fakes and the options passed
+    to main, and returns the operation to time.
+
+    """
+
+    def register(setup):
+        SCENARIOS[name] = (setup, iterations)
+        return setup
+    return register
+
+
+def _random_bitmap():
+    return ''.join(chr(random.randrange(256)) for i in xrange(CANVAS_BITMAP_SIZE))
+
+
+def _random_placement():
+    return (
+        random.randrange(16),
+        random.randrange(CANVAS_WIDTH),
+        random.randrange(CANVAS_HEIGHT),
+    )
+
+
+@scenario("draw", iterations=2000)
+def draw(fakes, options):
+    """A user placing a single pixel, as POST_draw does."""
+    users = itertools.count(1)
+
+    def op():
+        user = FakeUser(next(users))
+        # a user that's placed before, but not within their cooldown.
+        # Set straight on the fake so it isn't counted as a round trip.
+        fakes["redis"]._set(
+            RedisCooldown._key(user), time.time() - PIXEL_COOLDOWN_SECONDS)
+        color, x, y = _random_placement()
+        wait_seconds, generation = place_pixel(user, color, x, y)
+        assert wait_seconds == 0
+    return op
+
+
+@scenario("drawrect", iterations=200)
+def drawrect(fakes, options):
+    """An admin filling in the largest rectangle POST_drawrect allows."""
+    size = ADMIN_RECT_DRAW_MAX_SIZE
+
+    def op():
+        color, x0, y0 = _random_placement()
+        x0 = min(x0, CANVAS_WIDTH - size)
+        y0 = min(y0, CANVAS_HEIGHT - size)
+        Pixel.create_many(None, [
+            (color, x, y)
+            for x in xrange(x0, x0 + size)
+            for y in xrange(y0, y0 + size)
+        ])
+    return op
+
+
+@scenario("board_read", iterations=200)
+def board_read(fakes, options):
+    """Reading the whole board out of redis."""
+    RedisCanvas.set_bitmap(_random_bitmap())
+    return RedisCanvas.get_board
+
+
+@scenario("board_bitmap", iterations=2000)
+def board_bitmap(fakes, options):
+    """GET_board_bitmap's path, in the `board_format` option's format."""
+    RedisCanvas.set_bitmap(_random_bitmap())
+    board_format = options.get("board_format")
+    # start cold, whatever ran before.
+    BOARD_BITMAP_CACHE.clear()
+
+    def op():
+        get_board_bitmap(RedisCanvas.get_board, board_format, use_shared=False)
+    return op
+
+
+@scenario("wait_seconds", iterations=2000)
+def wait_seconds(fakes, options):
+    """Looking up a user's cooldown, with a share of cache misses."""
+    miss_rate = options.get("cooldown_miss_rate", 0.1)
+    users = itertools.count(1)
+
+    def op():
+        user = FakeUser(next(users))
+        if random.random() >= miss_rate:
+            fakes["redis"]._set(RedisCooldown._key(user), time.time())
+
+        # each op is a request of its own, with nothing memoized yet.
+        c.place_memo = None
+        get_wait_seconds(user)
+    return op
+
+
+class _StoredPixel(object):
+    def __init__(self, color, x, y, user_id):
+        self._id = uuid.uuid1()
+        self.color = color
+        self.x = x
+        self.y = y
+        self.user_name = "user%d" % user_id
+        self.user_fullname = FakeUser(user_id)._fullname
+
+
+@scenario("restore", iterations=3)
+def restore(fakes, options):
+    """Restoring redis from a canvas of `restore_pixels` pixels."""
+    pixels = options.get("restore_pixels", CANVAS_WIDTH * CANVAS_HEIGHT)
+    cf = fakes["cfs"][Canvas]
+
+    for i in xrange(pixels):
+        y, x = divmod(i % (CANVAS_WIDTH * CANVAS_HEIGHT), CANVAS_WIDTH)
+        pixel = _StoredPixel(random.randrange(16), x, y, i % 100000 + 1)
+        columns = Canvas._columns(pixel)
+        for rowkey in Canvas._write_rowkeys(x, y):
+            cf._insert(rowkey, columns)
+
+    def op():
+        lib.restore_redis_board_from_cass(
+            threads=options.get("restore_threads", 10))
+    return op
+
+
+def _percentile(sorted_values, percentile):
+    index = int(round(percentile / 100. * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_scenario(name, options):
+    """Run a scenario against fresh fakes and return its results."""
+    setup, iterations = SCENARIOS[name]
+    iterations = options.get("iterations", {}).get(name, iterations)
+
+    redis_latency = Latency.from_ms(
+        options.get("redis_latency_ms", 0.2),
+        options.get("redis_tail_ms"),
+    )
+    cass_latency = Latency.from_ms(
+        options.get("cass_latency_ms", 2),
+        options.get("cass_tail_ms"),
+    )
+
+    random.seed(0)
+    with fake_backends(redis_latency, cass_latency, options.get("config")) \
+            as fakes:
+        op = setup(fakes, options)
+
+        # gc is off while timing, so the count of tracked objects only goes
+        # up with each allocation that is still alive at the end.
+        gc.collect()
+        gc.disable()
+        objects_before = len(gc.get_objects())
+        maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        round_trips_before = (
+            redis_latency.round_trips + cass_latency.round_trips)
+        try:
+            timings = []
+            started = time.time()
+            for i in xrange(iterations):
+                op_started = time.time()
+                op()
+                timings.append(time.time() - op_started)
+            elapsed = time.time() - started
+        finally:
+            objects = len(gc.get_objects()) - objects_before
+            gc.enable()
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        round_trips = (redis_latency.round_trips + cass_latency.round_trips -
+                       round_trips_before)
+
+    timings.sort()
+    return OrderedDict([
+        ("iterations", iterations),
+        ("ops_per_sec", iterations / elapsed),
+        ("p50_ms", _percentile(timings, 50) * 1000),
+        ("p99_ms", _percentile(timings, 99) * 1000),
+        ("round_trips_per_op", round_trips / float(iterations)),
+        ("objects_per_op", objects / float(iterations)),
+        ("maxrss_growth_kb", maxrss - maxrss_before),
+    ])
+
+
+def _print_results(name, results, baseline=None):
+    print name
+    for metric, value in results.iteritems():
+        line = "    %-20s %12.3f" % (metric, value)
+        if baseline and baseline.get(metric):
+            change = (value - baseline[metric]) / baseline[metric] * 100
+            line += "  (%+.1f%% vs %.3f)" % (change, baseline[metric])
+        print line
+
+
+def main(scenarios=None, save=None, baseline=None, **options):
+    """Run the benchmarks and print the results.
+
+    `scenarios` is a list of names to run, all of them by default.  `save`
+    writes the results to a JSON file that can be passed as `baseline` to
+    compare a later run against.  Other options:
+
+        redis_latency_ms, cass_latency_ms - median round trip times
+        redis_tail_ms, cass_tail_ms - latency of the slowest 1% of trips
+        iterations - dict of scenario name -> iterations to run
+        config - dict of settings on g, e.g. {"place_write_behind": True}
+        restore_pixels, restore_threads - size of the restore scenario
+        cooldown_miss_rate - share of wait_seconds lookups that miss redis
+        board_format - format the board_bitmap scenario asks for, e.g. "rle"
+
+    """
+
+    baseline_results = {}
+    if baseline:
+        with open(baseline) as f:
+            baseline_results = json.load(f)
+
+    all_results = OrderedDict()
+    for name in scenarios or SCENARIOS.keys():
+        results = run_scenario(name, options)
+        _print_results(name, results, baseline_results.get(name))
+        all_results[name] = results
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+    return all_results
@@ -0,0 +1,101 @@
+"""
+Alternative encodings of the board-bitmap response.
+
+Every format keeps the header at the start of the response as-is and only
+changes how the bitmap after it is encoded.
+
+"""
+
+import re
+import zlib
+
+from reddit_place.cache import SnapshotCache
+from reddit_place.models import BOARD_HEADER, RedisCanvas
+
+
+# PackBits headers can describe at most 128 bytes at a time.
+MAX_PACKBITS_RUN = 128
+# Runs shorter than this are cheaper to send as part of a literal.
+MIN_PACKBITS_RUN = 3
+_RUN_RE = re.compile(r"(.)\1{%d,}" % (MIN_PACKBITS_RUN - 1), re.DOTALL)
+
+
+def _packbits_literal(data, start, end, out):
+    for i in xrange(start, end, MAX_PACKBITS_RUN):
+        chunk = data[i:min(end, i + MAX_PACKBITS_RUN)]
+        out.append(chr(len(chunk) - 1))
+        out.append(chunk)
+
+
+def packbits(data):
+    """Run-length encode a string with the PackBits scheme.
+
+    Each header byte n is followed by either n + 1 literal bytes (n < 128) or
+    a single byte to be repeated 257 - n times (n > 128).  Finding the runs is
+    left to the regex engine so the work in Python is per run rather than per
+    byte.
+
+    """
+
+    out = []
+    literal_start = 0
+    for match in _RUN_RE.finditer(data):
+        start, end = match.span()
+        _packbits_literal(data, literal_start, start, out)
+
+        byte = match.group(1)
+        for i in xrange(start, end, MAX_PACKBITS_RUN):
+            length = min(end - i, MAX_PACKBITS_RUN)
+            if length < MIN_PACKBITS_RUN:
+                out.append(chr(length - 1))
+                out.append(byte * length)
+            else:
+                out.append(chr(257 - length))
+                out.append(byte)
+        literal_start = end
+
+    _packbits_literal(data, literal_start, len(data), out)
+    return ''.join(out)
+
+
+def encode_rle(board):
+    return board[:BOARD_HEADER.size] + packbits(board[BOARD_HEADER.size:])
+
+
+def encode_deflate(board):
+    # Served with Content-Encoding: deflate, so the browser inflates it as it
+    # streams in and the client sees the usual response.
+    return zlib.compress(board, 6)
+
+
+BOARD_FORMATS = {
+    "rle": encode_rle,
+    "deflate": encode_deflate,
+}
+
+
+BOARD_BITMAP_CACHE = SnapshotCache(
+    key="place:board_bitmap",
+    ttl=1,
+    stat_name="place.board_bitmap.cache",
+    # renders only need redoing when the board has actually changed.
+    version=RedisCanvas.get_board_generation,
+)
+
+
+def get_board_bitmap(fill, board_format=None, use_shared=True):
+    """Return the cached board and the board-bitmap body in `board_format`.
+
+    The body is always built from the board returned alongside it, so the
+    board can be used to describe the body even if the cache was refilled in
+    the meantime.
+
+    """
+
+    board = BOARD_BITMAP_CACHE.get(fill, use_shared=use_shared)
+    if not board_format:
+        return board, board
+
+    body = BOARD_BITMAP_CACHE.get_derived(
+        board_format, BOARD_FORMATS[board_format], board)
+    return board, body
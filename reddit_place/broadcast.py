@@ -0,0 +1,167 @@
+import array
+import base64
+import struct
+import sys
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import amqp, websockets
+
+from reddit_place.models import CANVAS_WIDTH, RedisChangeLog
+
+
+BROADCAST_QUEUE = "place_broadcast_q"
+# How often the consumer publishes a batch of placements to the websockets.
+DEFAULT_BROADCAST_INTERVAL_MS = 100
+# Most placements to put in one batch-place message.
+MAX_BATCH_SIZE = 5000
+# The board generation each placement was made in.
+SEQ = struct.Struct("<I")
+
+
+def pack_placement(author, x, y, color, generation):
+    """Encode a placement for the broadcast queue.
+
+    The pixel is packed the same way as in the change log, followed by the
+    board generation it was placed in and the author's name.
+
+    """
+
+    return (RedisChangeLog.pack(color, x, y) + SEQ.pack(generation) +
+            author.encode("utf-8"))
+
+
+def unpack_placement(packed):
+    offset, color = next(RedisChangeLog.unpack(packed[:4]))
+    y, x = divmod(offset, CANVAS_WIDTH)
+    generation, = SEQ.unpack_from(packed, 4)
+    author = packed[4 + SEQ.size:].decode("utf-8")
+    return author, x, y, color, generation
+
+
+def encode_packed_placements(packed_placements):
+    """Build a binary batch-place payload from packed placements.
+
+    `pixels` is base64 of the packed uint32 records, `seqs` of the uint32
+    generation of each, and `author_ids` is base64 of a uint16 per record
+    indexing into `authors`, so each author's name is only sent once per
+    batch.
+
+    """
+
+    pixels = []
+    seqs = []
+    author_ids = array.array('H')
+    author_index = {}
+    authors = []
+    for packed in packed_placements:
+        pixels.append(packed[:4])
+        seqs.append(packed[4:4 + SEQ.size])
+        author = packed[4 + SEQ.size:].decode("utf-8")
+        if author not in author_index:
+            author_index[author] = len(authors)
+            authors.append(author)
+        author_ids.append(author_index[author])
+
+    if sys.byteorder == 'big':
+        author_ids.byteswap()
+
+    return {
+        "format": "binary",
+        "authors": authors,
+        "pixels": base64.b64encode(''.join(pixels)),
+        "seqs": base64.b64encode(''.join(seqs)),
+        "author_ids": base64.b64encode(author_ids.tostring()),
+    }
+
+
+def encode_placements(packed_placements):
+    """Build a batch-place payload from packed placements.
+
+    With `place_binary_broadcasts` on the batch is sent in the binary format,
+    otherwise as parallel arrays of author, x, y, color and seq.  Clients tell
+    the two apart from the shape of the payload.
+
+    Each placement's seq is the board generation it was placed in, which
+    clients compare against the generation in the board-bitmap header to
+    tell whether their copy of the board already has it.
+
+    """
+
+    if g.live_config.get("place_binary_broadcasts", False):
+        return encode_packed_placements(packed_placements)
+
+    authors, xs, ys, colors, seqs = [], [], [], [], []
+    for packed in packed_placements:
+        author, x, y, color, generation = unpack_placement(packed)
+        authors.append(author)
+        xs.append(x)
+        ys.append(y)
+        colors.append(color)
+        seqs.append(generation)
+
+    return {
+        "author": authors,
+        "x": xs,
+        "y": ys,
+        "color": colors,
+        "seq": seqs,
+    }
+
+
+def broadcast_placements(placements):
+    """Immediately broadcast (author, x, y, color, generation) placements."""
+    packed_placements = [
+        pack_placement(author, x, y, color, generation)
+        for author, x, y, color, generation in placements
+    ]
+    websockets.send_broadcast(
+        namespace="/place",
+        type="batch-place",
+        payload=encode_placements(packed_placements),
+    )
+
+
+def queue_placement(author, x, y, color, generation):
+    """Queue a placement to go out in the next batch-place broadcast."""
+    amqp.add_item(
+        BROADCAST_QUEUE,
+        pack_placement(author, x, y, color, generation),
+        delivery_mode=amqp.DELIVERY_TRANSIENT,
+    )
+
+
+def process_broadcasts():
+    """Publish queued placements as one batch-place message per interval.
+
+    The number of websocket messages fanned out to clients grows with the
+    interval rather than with the number of placements.  Only run a single
+    instance of this consumer, each one publishes its own batches.
+
+    """
+
+    interval = getattr(
+        g, "place_broadcast_interval_ms", DEFAULT_BROADCAST_INTERVAL_MS)
+    interval = interval / 1000.
+
+    @g.stats.amqp_processor(BROADCAST_QUEUE)
+    def send_batch(msgs, chan):
+        started = time.time()
+        websockets.send_broadcast(
+            namespace="/place",
+            type="batch-place",
+            payload=encode_placements([msg.body for msg in msgs]),
+        )
+        g.stats.simple_event("place.broadcast.batch")
+        g.stats.simple_event("place.broadcast.placements", delta=len(msgs))
+
+        # hold off so the next batch has time to fill up.
+        time.sleep(max(0, interval - (time.time() - started)))
+
+    amqp.handle_items(
+        BROADCAST_QUEUE,
+        send_batch,
+        limit=MAX_BATCH_SIZE,
+        sleep_time=interval,
+    )
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import functools
+import threading
+import time
+
+from pylons import app_globals as g
+from pylons import tmpl_context as c
+
+
+class SnapshotCache(object):
+    """Two-tier cache for a single, frequently read value.
+
+    The first tier is a copy held in this process, the second is the shared
+    stalecache.  When the local copy expires only one caller per process goes
+    on to refill it, anyone else asking in the meantime waits for that refill
+    to finish rather than hitting the backend themselves.
+
+    `version` is a function returning a version of a value, so anything
+    derived from it is only rebuilt when its contents change rather than
+    with every refill.  By default the value is its own version.
+
+    """
+
+    def __init__(self, key, ttl, stat_name, max_derived=8, version=None):
+        self.key = key
+        self.ttl = ttl
+        self.stat_name = stat_name
+        self.max_derived = max_derived
+        self.version = version or (lambda value: value)
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._derived = OrderedDict()
+        # one lock per name, so a slow render doesn't hold up the others.
+        self._derive_locks = {}
+        # guards _derived itself, only held while storing into it.
+        self._derived_lock = threading.Lock()
+
+    def _count(self, outcome):
+        g.stats.simple_event("%s.%s" % (self.stat_name, outcome))
+
+    def _current(self):
+        if self._value is not None and time.time() < self._expires:
+            return self._value
+        return None
+
+    def peek(self):
+        """Return the value if this process has a fresh copy, else None."""
+        return self._current()
+
+    def last(self):
+        """Return the last value this process had, however old, or None."""
+        return self._value
+
+    def clear(self):
+        """Forget this process's copy and everything derived from it."""
+        with self._lock, self._derived_lock:
+            self._value = None
+            self._expires = 0
+            self._derived.clear()
+
+    def get(self, fill, use_shared=True):
+        """Return the cached value, calling `fill` to rebuild it if needed.
+
+        `use_shared` controls whether the stalecache tier is consulted (and
+        populated) before falling back to `fill`.
+
+        """
+
+        value = self._current()
+        if value is not None:
+            self._count("hit")
+            return value
+
+        if not self._lock.acquire(False):
+            # someone else in this process is already refilling, wait for
+            # them instead of doing the same work twice.
+            self._lock.acquire()
+
+        try:
+            value = self._current()
+            if value is not None:
+                self._count("coalesced_wait")
+                return value
+
+            self._count("miss")
+            return self._refill(fill, use_shared)
+        finally:
+            self._lock.release()
+
+    def get_derived(self, name, derive, value):
+        """Return derive(value), only rebuilding it when the value changes.
+
+        `value` is one returned by get, passed in rather than fetched again so
+        that the caller can describe it knowing the derived value matches,
+        even if a refill happens in between.
+
+        Derived values are keyed on (version, name), so each is built at most
+        once per version however many requests and refills there are.  Only
+        the `max_derived` most recently built are kept.
+
+        """
+
+        version = self.version(value)
+
+        cached = self._derived.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        derive_lock = self._derive_locks.get(name)
+        if derive_lock is None:
+            derive_lock = self._derive_locks.setdefault(
+                name, threading.Lock())
+
+        with derive_lock:
+            cached = self._derived.get(name)
+            if cached and cached[0] == version:
+                return cached[1]
+
+            derived = derive(value)
+            with self._derived_lock:
+                self._derived.pop(name, None)
+                self._derived[name] = (version, derived)
+                while len(self._derived) > self.max_derived:
+                    self._derived.popitem(last=False)
+            return derived
+
+    def _refill(self, fill, use_shared):
+        use_shared = use_shared and g.stalecache
+
+        value = None
+        if use_shared:
+            value = g.stalecache.get(self.key)
+
+        if not value:
+            value = fill()
+            if use_shared:
+                g.stalecache.set(self.key, value, time=self.ttl, noreply=True)
+
+        self._value = value
+        self._expires = time.time() + self.ttl
+        return value
+
+
+def request_memoize(key):
+    """Compute the decorated function at most once per request per arguments.
+
+    Results are kept in a dict on `c`, so they go away with the request.
+
+    """
+
+    def memoize_decorator(fn):
+        @functools.wraps(fn)
+        def memoized(*args):
+            memo = getattr(c, "place_memo", None)
+            if not isinstance(memo, dict):
+                memo = c.place_memo = {}
+
+            memo_key = (key,) + args
+            if memo_key not in memo:
+                memo[memo_key] = fn(*args)
+            return memo[memo_key]
+        return memoized
+    return memoize_decorator
@@ -1,10 +1,11 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 
 from pylons import app_globals as g
 from pylons import tmpl_context as c
 from pylons import response, request
 from pylons.i18n import _
+from redis.exceptions import RedisError
 
 from r2.config import feature
 from r2.controllers import add_controller
@@ -17,7 +18,7 @@ from r2.lib import (
     baseplate_integration,
     websockets,
 )
-from r2.lib.base import BaseController
+from r2.lib.base import abort, BaseController
 from r2.lib.errors import errors
 from r2.lib.pages import SideBox
 from r2.lib.utils import SimpleSillyStub
@@ -36,14 +37,32 @@ from r2.controllers.oauth2 import (
     allow_oauth2_access,
 )
 
-from . import events
+from . import broadcast, degraded, events, history, stages
+from .board_formats import (
+    BOARD_BITMAP_CACHE,
+    BOARD_FORMATS,
+    get_board_bitmap,
+)
+from .cache import request_memoize
 from .models import (
+    ADMIN_RECT_DRAW_MAX_SIZE,
+    BOARD_HEADER,
+    BoardKeyframesByTime,
     CANVAS_ID,
     CANVAS_WIDTH,
     CANVAS_HEIGHT,
+    CANVAS_TILES_X,
+    CANVAS_TILES_Y,
+    get_wait_seconds,
     Pixel,
+    PIXEL_COOLDOWN_SECONDS,
+    place_pixel,
     RedisCanvas,
+    RedisChangeLog,
 )
+from .render import MAX_PNG_SCALE, render_board_png
+from .snapshot import latest_snapshot
+from .stages import stage
 from .pages import (
     PlaceEmbedPage,
     PlacePage,
@@ -55,10 +74,17 @@ controller_hooks = hooks.HookRegistrar()
 
 
 ACCOUNT_CREATION_CUTOFF = datetime(2017, 3, 31, 0, 0, tzinfo=g.tz)
-PIXEL_COOLDOWN_SECONDS = 300
-PIXEL_COOLDOWN = timedelta(seconds=PIXEL_COOLDOWN_SECONDS)
-ADMIN_RECT_DRAW_MAX_SIZE = 20
+PIXEL_REGION_MAX_SIZE = 20
 PLACE_SUBREDDIT = Subreddit._by_name("place", stale=True)
+WEBSOCKET_URL_MAX_AGE = 3600
+# Hand out the same signed websocket URL for this long.
+WEBSOCKET_URL_REUSE = WEBSOCKET_URL_MAX_AGE / 4
+ACTIVITY_COUNT_KEY = "place:activity_count"
+DEFAULT_ACTIVITY_MAX_AGE = 120
+HISTORY_MAX_AGE = 86400
+HISTORY_START_KEY = "place:history_start"
+# Only changes when history is first started, so this can be long.
+HISTORY_START_CACHE_TIME = 600
 
 
 @add_controller
@@ -90,22 +116,92 @@ class LoggedOutPlaceController(BaseController):
     # BaseController.  This lets us avoid the cache poisoning and logged in
     # checks embedded in MinimalController that would prevent caching.
 
+    def _get_last_good_board(self):
+        """Return the newest board we have without going to redis, or None.
+
+        That's whichever of the last board cached in this process and the
+        snapshot on disk was read from redis most recently.  It may be a
+        buffer over the snapshot file.
+
+        """
+
+        boards = []
+        cached = BOARD_BITMAP_CACHE.last()
+        if cached:
+            boards.append(cached)
+        snapshot = latest_snapshot.get()
+        if snapshot:
+            boards.append(snapshot.board)
+
+        if not boards:
+            return None
+        return max(boards, key=BOARD_HEADER.unpack_from)
+
     def _get_board_bitmap(self):
+        if degraded.is_degraded("redis"):
+            board = self._get_last_good_board()
+            if board:
+                g.stats.simple_event("place.board_bitmap.degraded")
+                return str(board)
 
         # Since we're not using MinimalController, we need to setup the
         # baseplate span manually to have access to the baseplate context.
         baseplate_integration.make_server_span(
             span_name="place.GET_board_bitmap").start()
-        response = RedisCanvas.get_board()
-        baseplate_integration.finish_server_span()
+        try:
+            with degraded.backend_call("redis"):
+                response = RedisCanvas.get_board()
+        except RedisError:
+            # Fall back to the last snapshot on disk if redis is unavailable
+            # or too slow to answer within its socket timeout.
+            snapshot = latest_snapshot.get()
+            if not snapshot:
+                raise
+            g.stats.simple_event("place.board_bitmap.snapshot_fallback")
+            # the one copy out of the mapped file, per cache refill.
+            response = str(snapshot.board)
+        finally:
+            baseplate_integration.finish_server_span()
         return response
 
-    @allow_oauth2_access
-    def GET_board_bitmap(self):
-        """
-        Get board bitmap with cache control determined by GET parames.
+    def _get_board_generation(self):
+        """Return the generation the board-bitmap would be served with.
+
+        This is only ever the small generation counter from redis, never the
+        board itself, or None if redis can't be reached.
+
         """
 
+        board = BOARD_BITMAP_CACHE.peek()
+        if board is None and degraded.is_degraded("redis"):
+            board = self._get_last_good_board()
+        if board is not None:
+            return RedisCanvas.get_board_generation(board)
+
+        baseplate_integration.make_server_span(
+            span_name="place.GET_board_generation").start()
+        try:
+            with degraded.backend_call("redis"):
+                return RedisCanvas.get_generation()
+        except RedisError:
+            return None
+        finally:
+            baseplate_integration.finish_server_span()
+
+    def _board_etag(self, generation, board_format):
+        # unquoted, as webob compares and sends them.
+        if board_format:
+            return "%d-%s" % (generation, board_format)
+        return "%d" % generation
+
+    def _get_board_tile(self, tx, ty):
+        baseplate_integration.make_server_span(
+            span_name="place.GET_board_tile").start()
+        response = RedisCanvas.get_tile(tx, ty)
+        baseplate_integration.finish_server_span()
+        return response
+
+    def _set_cache_control(self):
         # nocache
         if 'nocache' in request.GET:
             response.headers['Cache-Control'] = 'private'
@@ -113,21 +209,112 @@ class LoggedOutPlaceController(BaseController):
             response.headers['Cache-Control'] = \
                 'max-age=1, stale-while-revalidate=1'
 
-        # nostalecache
-        dont_stalecache = 'nostalecache' in request.GET or not g.stalecache
-        if dont_stalecache:
-            board_bitmap = None
-        else:
-            board_bitmap = g.stalecache.get('place:board_bitmap')
+    @allow_oauth2_access
+    def GET_board_bitmap(self):
+        """
+        Get board bitmap with cache control determined by GET parames.
+        """
+
+        board_format = get_board_format()
+
+        self._set_cache_control()
+
+        # Revalidation only needs the board's generation, so a client that's
+        # already up to date doesn't cost us a read of the whole board.
+        if request.if_none_match:
+            generation = self._get_board_generation()
+            if generation is not None:
+                etag = self._board_etag(generation, board_format)
+                if etag in request.if_none_match:
+                    g.stats.simple_event("place.board_bitmap.not_modified")
+                    response.etag = etag
+                    response.status_int = 304
+                    return ""
+
+        # nostalecache skips the shared tier, but we still only go to redis
+        # once per ttl per process.
+        use_stalecache = 'nostalecache' not in request.GET
+
+        board, body = get_board_bitmap(
+            self._get_board_bitmap, board_format, use_shared=use_stalecache)
+        response.etag = self._board_etag(
+            RedisCanvas.get_board_generation(board), board_format)
+        return body
+
+    @allow_oauth2_access
+    def GET_board_png(self):
+        """
+        Get the board rendered as a PNG, `scale` pixels per tile.
+
+        Renders are cached alongside the board bitmap, so there's at most one
+        per scale per process each time the bitmap is refreshed.
+        """
+
+        try:
+            scale = int(request.GET.get("scale", 1))
+        except ValueError:
+            abort(400)
+
+        if not 1 <= scale <= MAX_PNG_SCALE:
+            abort(400)
 
-        # redis
-        if not board_bitmap:
-            board_bitmap = self._get_board_bitmap()
-            if not dont_stalecache:
-                g.stalecache.set('place:board_bitmap', board_bitmap, time=1,
-                                 noreply=True)
+        self._set_cache_control()
+        response.content_type = "image/png"
 
-        return self._get_board_bitmap()
+        board = BOARD_BITMAP_CACHE.get(self._get_board_bitmap)
+        return BOARD_BITMAP_CACHE.get_derived(
+            "png:%d" % scale,
+            lambda board: render_board_png(board, scale),
+            board,
+        )
+
+    @allow_oauth2_access
+    def GET_board_tile(self):
+        """
+        Get the bitmap of a single CANVAS_TILE_SIZE square tile of the board.
+
+        Tiles are addressed by their column and row in the grid of tiles, not
+        by pixel coordinates.
+        """
+
+        try:
+            tx = int(request.GET["tx"])
+            ty = int(request.GET["ty"])
+        except (KeyError, ValueError):
+            abort(400)
+
+        if not (0 <= tx < CANVAS_TILES_X and 0 <= ty < CANVAS_TILES_Y):
+            abort(404)
+
+        self._set_cache_control()
+        return self._get_board_tile(tx, ty)
+
+    @allow_oauth2_access
+    def GET_board_delta(self):
+        """
+        Get the pixels placed since a timestamp, as packed uint32 records.
+
+        The response starts with a timestamp to use for the next request, in
+        the same format as the board bitmap.  Each record after it is
+        `offset << 4 | color`.  If the change log doesn't go back far enough
+        the response is a 410 and the client should fetch the full bitmap.
+        """
+
+        try:
+            since = float(request.GET["since"])
+        except (KeyError, ValueError):
+            abort(400)
+
+        self._set_cache_control()
+
+        baseplate_integration.make_server_span(
+            span_name="place.GET_board_delta").start()
+        delta = RedisChangeLog.get_delta(since)
+        baseplate_integration.finish_server_span()
+
+        if delta is None:
+            abort(410)
+        return delta
 
     def post(self):
         c.request_timer.stop()
@@ -145,7 +332,7 @@ class ActivityError:
     pass
 
 
-def get_activity_count():
+def compute_activity_count():
     activity = PLACE_SUBREDDIT.count_activity()
 
     if not activity:
@@ -159,6 +346,42 @@ def get_activity_count():
     return count
 
 
+def cache_activity_count(count):
+    g.cache.set(ACTIVITY_COUNT_KEY, (count, time.time()))
+
+
+def get_history_start():
+    """Return the time of the earliest keyframe, or None before history."""
+    history_start = g.cache.get(HISTORY_START_KEY)
+    if history_start is None:
+        history_start = BoardKeyframesByTime.get_earliest() or 0
+        g.cache.set(
+            HISTORY_START_KEY, history_start, time=HISTORY_START_CACHE_TIME)
+    return history_start or None
+
+
+@request_memoize("place.activity_count")
+def get_activity_count():
+    """Return the active visitor count, preferably as cached by the job.
+
+    activity.broadcast_activity keeps the cached count up to date, it's only
+    computed here if that's missing or older than place_activity_max_age.
+
+    """
+
+    max_age = getattr(g, "place_activity_max_age", DEFAULT_ACTIVITY_MAX_AGE)
+    cached = g.cache.get(ACTIVITY_COUNT_KEY)
+    if cached:
+        count, timestamp = cached
+        if time.time() - timestamp <= max_age:
+            return count
+
+    g.stats.simple_event("place.activity_count.recompute")
+    count = compute_activity_count()
+    cache_activity_count(count)
+    return count
+
+
 @add_controller
 class PlaceController(RedditController):
     def pre(self):
@@ -173,6 +396,10 @@ class PlaceController(RedditController):
         if c.user._spam:
             self.abort403()
 
+    def post(self):
+        stages.add_debug_header(response)
+        RedditController.post(self)
+
     @validate(
         is_embed=VBoolean("is_embed"),
         is_webview=VBoolean("webview", default=False),
@@ -190,32 +417,19 @@ class PlaceController(RedditController):
         request.environ['render_style'] = "html"
         set_content_type()
 
-        websocket_url = websockets.make_url("/place", max_age=3600)
-
         content = PlaceCanvasse()
 
-        js_config = {
-            "place_websocket_url": websocket_url,
-            "place_canvas_width": CANVAS_WIDTH,
-            "place_canvas_height": CANVAS_HEIGHT,
-            "place_cooldown": 0 if c.user_is_admin else PIXEL_COOLDOWN_SECONDS,
-            "place_fullscreen": is_embed or is_webview,
-            "place_hide_ui": is_palette_hidden,
-        }
-
-        if c.user_is_loggedin and not c.user_is_admin:
-            js_config["place_wait_seconds"] = get_wait_seconds(c.user)
-
         # this is a sad duplication of the same from reddit_base :(
         if c.user_is_loggedin:
             PLACE_SUBREDDIT.record_visitor_activity("logged_in", c.user._fullname)
         elif c.loid.serializable:
             PLACE_SUBREDDIT.record_visitor_activity("logged_out", c.loid.loid)
 
-        try:
-            js_config["place_active_visitors"] = get_activity_count()
-        except ActivityError:
-            pass
+        js_config = make_place_config()
+        js_config.update({
+            "place_fullscreen": is_embed or is_webview,
+            "place_hide_ui": is_palette_hidden,
+        })
 
         if is_embed:
             # ensure we're off the cookie domain before allowing embedding
@@ -249,6 +463,18 @@ class PlaceController(RedditController):
         # End the game
         self.abort403()
 
+        # Turn draws away before they cost the backends anything at all.
+        if degraded.is_degraded():
+            g.stats.simple_event("place.draw.degraded")
+            response.status = 503
+            response.headers["Retry-After"] = str(
+                degraded.RETRY_AFTER_SECONDS)
+            request.environ['extra_error_data'] = {
+                "error": 503,
+                "retry_after": degraded.RETRY_AFTER_SECONDS,
+            }
+            return
+
         if c.user._date >= ACCOUNT_CREATION_CUTOFF:
             self.abort403()
 
@@ -291,38 +517,29 @@ class PlaceController(RedditController):
             return
 
         if c.user_is_admin:
-            wait_seconds = 0
+            generation = Pixel.create(c.user, color, x, y)._generation
         else:
-            wait_seconds = get_wait_seconds(c.user)
-
-        if wait_seconds > 2:
-            response.status = 429
-            request.environ['extra_error_data'] = {
-                "error": 429,
-                "wait_seconds": wait_seconds,
-            }
-            return
+            wait_seconds, generation = place_pixel(c.user, color, x, y)
+            if wait_seconds > 0:
+                response.status = 429
+                request.environ['extra_error_data'] = {
+                    "error": 429,
+                    "wait_seconds": wait_seconds,
+                }
+                return
 
-        Pixel.create(c.user, color, x, y)
+        with stage("set_flair"):
+            c.user.set_flair(
+                subreddit=PLACE_SUBREDDIT,
+                text="({x},{y}) {time}".format(x=x, y=y, time=time.time()),
+                css_class="place-%s" % color,
+            )
 
-        c.user.set_flair(
-            subreddit=PLACE_SUBREDDIT,
-            text="({x},{y}) {time}".format(x=x, y=y, time=time.time()),
-            css_class="place-%s" % color,
-        )
+        with stage("broadcast"):
+            broadcast.queue_placement(c.user.name, x, y, color, generation)
 
-        websockets.send_broadcast(
-            namespace="/place",
-            type="place",
-            payload={
-                "author": c.user.name,
-                "x": x,
-                "y": y,
-                "color": color,
-            }
-        )
-
-        events.place_pixel(x, y, color)
+        with stage("event"):
+            events.place_pixel(x, y, color)
         cooldown = 0 if c.user_is_admin else PIXEL_COOLDOWN_SECONDS
         return {
             'wait_seconds': cooldown,
@@ -376,24 +593,56 @@ class PlaceController(RedditController):
         width = min(CANVAS_WIDTH - x, width)
         height = min(CANVAS_HEIGHT - y, height)
 
-        batch_payload = []
+        placements = [
+            (0, _x, _y)
+            for _x in xrange(x, x + width)
+            for _y in xrange(y, y + height)
+        ]
+        pixels = Pixel.create_many(None, placements)
 
-        for _x in xrange(x, x + width):
-            for _y in xrange(y, y + height):
-                pixel = Pixel.create(None, 0, _x, _y)
-                payload = {
-                    "author": '',
-                    "x": _x,
-                    "y": _y,
-                    "color": 0,
-                }
-                batch_payload.append(payload)
+        with stage("broadcast"):
+            broadcast.broadcast_placements([
+                ('', pixel.x, pixel.y, pixel.color, pixel._generation)
+                for pixel in pixels
+            ])
 
-        websockets.send_broadcast(
-            namespace="/place",
-            type="batch-place",
-            payload=batch_payload,
-        )
+    @validate(
+        VAdmin(),
+        at=VInt("at", min=0, coerce=False),
+    )
+    def GET_board_history(self, at):
+        """
+        Get the board bitmap as it was at time `at`.
+
+        Rebuilding a past board can mean replaying minutes of placements from
+        cassandra, so this is only for admins, for the history slider.
+        """
+
+        if at is None:
+            abort(400)
+
+        if at > time.time():
+            abort(404)
+
+        board_format = get_board_format()
+
+        try:
+            bitmap = history.get_bitmap_at(at)
+        except history.HistoryError:
+            abort(404)
+
+        if history.is_settled(at):
+            # nothing can change the board at this point any more.
+            response.headers['Cache-Control'] = \
+                'private, max-age=%d' % HISTORY_MAX_AGE
+        else:
+            response.headers['Cache-Control'] = 'private'
+
+        # Past boards aren't versioned, they're identified by `at` alone.
+        board = BOARD_HEADER.pack(at, 0) + bitmap
+        if not board_format:
+            return board
+        return BOARD_FORMATS[board_format](board)
 
     @json_validate(
         VUser(),
@@ -453,18 +702,80 @@ class PlaceController(RedditController):
             # pixels blanked out by admins will not have a user_name set
             return pixel
 
+    @json_validate(
+        x0=VInt("x0", min=0, max=CANVAS_WIDTH, coerce=False),
+        y0=VInt("y0", min=0, max=CANVAS_HEIGHT, coerce=False),
+        x1=VInt("x1", min=0, max=CANVAS_WIDTH, coerce=False),
+        y1=VInt("y1", min=0, max=CANVAS_HEIGHT, coerce=False),
+    )
+    @allow_oauth2_access
+    def GET_pixels(self, responder, x0, y0, x1, y1):
+        """
+        Get info about every pixel in the inclusive rectangle x0,y0 - x1,y1.
+
+        Lets the inspector prefetch the neighborhood of a pixel in one
+        request rather than asking for pixels one at a time.
+        """
+
+        coords = (
+            ("x0", x0, CANVAS_WIDTH),
+            ("y0", y0, CANVAS_HEIGHT),
+            ("x1", x1, CANVAS_WIDTH),
+            ("y1", y1, CANVAS_HEIGHT),
+        )
+        for field, value, maximum in coords:
+            if value is None:
+                # copy the error set by VNumber/VInt
+                c.errors.add(
+                    error_name=errors.BAD_NUMBER,
+                    field=field,
+                    msg_params={
+                        "range": _("%(min)d to %(max)d") % {
+                            "min": 0,
+                            "max": maximum,
+                        },
+                    },
+                )
+
+        if any(responder.has_errors(field, errors.BAD_NUMBER)
+               for field, value, maximum in coords):
+            return
+
+        if not (0 <= x1 - x0 < PIXEL_REGION_MAX_SIZE and
+                0 <= y1 - y0 < PIXEL_REGION_MAX_SIZE):
+            abort(400)
+
+        pixels = Pixel.get_pixels_in(x0, y0, x1, y1)
+        return {
+            # pixels blanked out by admins will not have a user_name set
+            "pixels": [
+                pixel for (x, y), pixel in sorted(pixels.iteritems())
+                if pixel["user_name"]
+            ],
+        }
+
+
+def get_board_format():
+    """Return the format to send the board-bitmap in, given the request.
+
+    Deflate is sent as a Content-Encoding, so it's only used if the client
+    accepts that encoding.  Anyone else gets the plain bitmap instead.
+
+    """
+
+    board_format = request.GET.get("format")
+    if board_format and board_format not in BOARD_FORMATS:
+        abort(400)
 
-def get_wait_seconds(user):
-    last_pixel_dt = Pixel.get_last_placement_datetime(user)
-    now = datetime.now(g.tz)
+    if board_format != "deflate":
+        return board_format
 
-    if last_pixel_dt and last_pixel_dt + PIXEL_COOLDOWN > now:
-        next_pixel_dt = last_pixel_dt + PIXEL_COOLDOWN
-        wait_seconds = (next_pixel_dt - now).total_seconds()
-    else:
-        wait_seconds = 0
+    response.vary = tuple(response.vary or ()) + ("Accept-Encoding",)
+    if "deflate" not in request.accept_encoding:
+        return None
 
-    return wait_seconds
+    response.headers["Content-Encoding"] = "deflate"
+    return board_format
 
 
 @controller_hooks.on("hot.get_content")
@@ -473,22 +784,63 @@ def add_canvasse(controller):
         return PlaceCanvasse()
 
 
+_websocket_url = None
+_websocket_url_expires = 0
+
+
+def get_websocket_url():
+    """Return a signed websocket URL for the place namespace.
+
+    The signature only covers the namespace and expiry, not the user, so one
+    URL is shared by the whole process until a fraction of its max_age has
+    passed.
+
+    """
+
+    global _websocket_url, _websocket_url_expires
+
+    now = time.time()
+    if not _websocket_url or now >= _websocket_url_expires:
+        _websocket_url = websockets.make_url(
+            "/place", max_age=WEBSOCKET_URL_MAX_AGE)
+        _websocket_url_expires = now + WEBSOCKET_URL_REUSE
+    return _websocket_url
+
+
+def make_place_config():
+    """Return the js_config shared by the canvas page and r/place."""
+    config = {
+        "place_websocket_url": get_websocket_url(),
+        "place_canvas_width": CANVAS_WIDTH,
+        "place_canvas_height": CANVAS_HEIGHT,
+        "place_cooldown": 0 if c.user_is_admin else PIXEL_COOLDOWN_SECONDS,
+    }
+
+    board_format = g.live_config.get("place_board_format")
+    if board_format in BOARD_FORMATS:
+        config["place_board_format"] = board_format
+
+    if c.user_is_loggedin and not c.user_is_admin:
+        config["place_wait_seconds"] = get_wait_seconds(c.user)
+
+    if c.user_is_admin:
+        # lets the admin slider scrub back through the board's history.
+        history_start = get_history_start()
+        if history_start is not None:
+            config["place_history_start"] = history_start
+
+    try:
+        config["place_active_visitors"] = get_activity_count()
+    except ActivityError:
+        pass
+
+    return config
+
+
 @controller_hooks.on("js_config")
 def add_place_config(config):
     if c.site.name == PLACE_SUBREDDIT.name:
-        cooldown = 0 if c.user_is_admin else PIXEL_COOLDOWN_SECONDS
-        websocket_url = websockets.make_url("/place", max_age=3600)
-        config["place_websocket_url"] = websocket_url
-        config["place_canvas_width"] = CANVAS_WIDTH
-        config["place_canvas_height"] = CANVAS_HEIGHT
-        config["place_cooldown"] = cooldown
-        if c.user_is_loggedin and not c.user_is_admin:
-            config["place_wait_seconds"] = get_wait_seconds(c.user)
-
-        try:
-            config["place_active_visitors"] = get_activity_count()
-        except ActivityError:
-            pass
+        config.update(make_place_config())
 
 
 @controller_hooks.on("extra_stylesheets")
@@ -0,0 +1,135 @@
+"""
+Degraded mode, for when redis or cassandra are struggling.
+
+While degraded, the board-bitmap is served from the last board this process
+saw or the snapshot on disk, whichever is newer, and draws are turned away
+with a 503 before they touch any backend.  Turn it on by hand with the
+`place_degraded` live config, or let the circuit breakers turn it on: with
+`place_circuit_breaker` on, each process keeps a breaker per backend that
+opens when too many recent calls to it fail or are slower than
+`place_breaker_slow_ms`.
+
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+from pylons import app_globals as g
+
+
+# Tell clients that were turned away to come back after this long.
+RETRY_AFTER_SECONDS = 30
+DEFAULT_SLOW_MS = 500
+DEFAULT_ERROR_RATE = 0.5
+# Calls are counted over the last this many seconds.
+WINDOW_SECONDS = 10
+# Don't trip on the first few calls of a quiet window.
+MIN_CALLS = 20
+# How long an open breaker stays open before calls are let through again.
+OPEN_SECONDS = 30
+# Good calls needed to close a breaker after it's let calls through again.
+HALF_OPEN_CALLS = 5
+
+
+class CircuitBreaker(object):
+    """Tracks the health of a backend from the calls this process makes.
+
+    Calls that raise or are too slow are bad.  The breaker opens when at
+    least `place_breaker_error_rate` of the calls in the last WINDOW_SECONDS
+    are bad.  After OPEN_SECONDS calls are let through again, a single bad one
+    opens it straight back up and HALF_OPEN_CALLS good ones close it.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._buckets = deque()
+        self._opened_at = None
+        self._half_open_calls = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        if self._opened_at is None:
+            return False
+
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.time() - self._opened_at < OPEN_SECONDS:
+                return True
+            self._opened_at = None
+            self._half_open_calls = 0
+            self._buckets.clear()
+        return False
+
+    def record(self, elapsed, failed):
+        slow_ms = g.live_config.get("place_breaker_slow_ms", DEFAULT_SLOW_MS)
+        bad = failed or elapsed * 1000 > slow_ms
+        now = int(time.time())
+
+        with self._lock:
+            if self._opened_at is not None:
+                return
+
+            if self._half_open_calls is not None:
+                if bad:
+                    self._open()
+                else:
+                    self._half_open_calls += 1
+                    if self._half_open_calls >= HALF_OPEN_CALLS:
+                        self._half_open_calls = None
+                return
+
+            if self._buckets and self._buckets[-1][0] == now:
+                bucket = self._buckets[-1]
+            else:
+                bucket = [now, 0, 0]
+                self._buckets.append(bucket)
+            bucket[1] += 1
+            bucket[2] += bad
+
+            while self._buckets[0][0] <= now - WINDOW_SECONDS:
+                self._buckets.popleft()
+
+            calls = sum(bucket[1] for bucket in self._buckets)
+            bad_calls = sum(bucket[2] for bucket in self._buckets)
+            error_rate = g.live_config.get(
+                "place_breaker_error_rate", DEFAULT_ERROR_RATE)
+            if calls >= MIN_CALLS and bad_calls >= error_rate * calls:
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.time()
+        self._half_open_calls = None
+        self._buckets.clear()
+        g.stats.simple_event("place.breaker.%s.open" % self.name)
+        g.log.warning("place: %s circuit breaker opened", self.name)
+
+
+BACKENDS = ("redis", "cassandra")
+breakers = {backend: CircuitBreaker(backend) for backend in BACKENDS}
+
+
+@contextmanager
+def backend_call(backend):
+    """Record how the body of the with block, a call to `backend`, went."""
+    started = time.time()
+    try:
+        yield
+    except Exception:
+        breakers[backend].record(time.time() - started, failed=True)
+        raise
+    breakers[backend].record(time.time() - started, failed=False)
+
+
+def is_degraded(*backends):
+    """Whether to avoid `backends`, or any backend if none are given."""
+    if g.live_config.get("place_degraded", False):
+        return True
+
+    if not g.live_config.get("place_circuit_breaker", False):
+        return False
+
+    return any(breakers[backend].is_open() for backend in backends or BACKENDS)
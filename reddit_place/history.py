@@ -0,0 +1,146 @@
+"""
+Rebuilding the board as it was at some point in the past.
+
+Every placement is also written to BoardChanges, in order, and a job rolls a
+keyframe of the whole board forward every HISTORY_INTERVAL seconds.  The
+board at any time since history was started is then the latest keyframe
+before that time plus at most one interval's worth of placements replayed on
+top of it.
+
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import baseplate_integration
+
+from reddit_place.models import (
+    BoardChanges,
+    BoardKeyframe,
+    BoardKeyframesByTime,
+    HISTORY_INTERVAL,
+    RedisCanvas,
+    RedisChangeLog,
+)
+
+
+# Wait this long after an interval ends before keyframing it, so placements
+# from the end of the interval have had time to land in cassandra.
+SETTLE_SECONDS = 60
+# How many keyframes each process keeps around for scrubbing.
+KEYFRAME_CACHE_SIZE = 32
+
+
+class HistoryError(Exception):
+    pass
+
+
+def set_nibble(bitmap, offset, color):
+    idx = offset / 2
+    if offset % 2:
+        bitmap[idx] = (bitmap[idx] & 0xF0) | color
+    else:
+        bitmap[idx] = (bitmap[idx] & 0x0F) | (color << 4)
+
+
+def apply_changes(bitmap, packed_changes):
+    """Replay packed change log records onto a bytearray bitmap, in order."""
+    for packed in packed_changes:
+        for offset, color in RedisChangeLog.unpack(packed):
+            set_nibble(bitmap, offset, color)
+
+
+class KeyframeCache(object):
+    """The most recently used keyframes, decompressed."""
+
+    def __init__(self, size):
+        self.size = size
+        self._keyframes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, timestamp):
+        with self._lock:
+            bitmap = self._keyframes.pop(timestamp, None)
+            if bitmap is not None:
+                self._keyframes[timestamp] = bitmap
+                return bitmap
+
+        bitmap = BoardKeyframe.get(timestamp)
+        if bitmap is None:
+            return None
+
+        with self._lock:
+            self._keyframes[timestamp] = bitmap
+            while len(self._keyframes) > self.size:
+                self._keyframes.popitem(last=False)
+        return bitmap
+
+
+keyframe_cache = KeyframeCache(KEYFRAME_CACHE_SIZE)
+
+
+def is_settled(at):
+    """Whether the board at `at` can't change any more."""
+    return at < time.time() - SETTLE_SECONDS
+
+
+def get_bitmap_at(at):
+    """Return the bitmap of the board as it was at time `at`."""
+    keyframe_time = BoardKeyframesByTime.get_latest(before=at)
+    if keyframe_time is None:
+        raise HistoryError("no history from before %d" % at)
+
+    keyframe = keyframe_cache.get(keyframe_time)
+    if keyframe is None:
+        raise HistoryError("keyframe %d is missing" % keyframe_time)
+
+    if keyframe_time == at:
+        return keyframe
+
+    g.stats.simple_event("place.history.replay")
+    bitmap = bytearray(keyframe)
+    apply_changes(bitmap, BoardChanges.iter_changes(keyframe_time, at))
+    return str(bitmap)
+
+
+def start_history():
+    """Write the first keyframe from the current board in redis.
+
+    Only needs to be run once, BoardChanges must already be getting written
+    so nothing placed after the keyframe is missed.
+
+    """
+
+    if BoardKeyframesByTime.get_latest() is not None:
+        raise HistoryError("history has already been started")
+
+    timestamp = int(time.time())
+    BoardKeyframe.add(timestamp, RedisCanvas.get_bitmap())
+    print "started history at %d" % timestamp
+
+
+@baseplate_integration.with_root_span("job.place_keyframes")
+def write_keyframes():
+    """Roll keyframes forward to the last settled interval."""
+    keyframe_time = BoardKeyframesByTime.get_latest()
+    if keyframe_time is None:
+        raise HistoryError("history hasn't been started")
+
+    settled = time.time() - SETTLE_SECONDS
+    bitmap = None
+    while keyframe_time + HISTORY_INTERVAL <= settled:
+        if bitmap is None:
+            keyframe = BoardKeyframe.get(keyframe_time)
+            if keyframe is None:
+                raise HistoryError("keyframe %d is missing" % keyframe_time)
+            bitmap = bytearray(keyframe)
+
+        next_time = keyframe_time + HISTORY_INTERVAL
+        apply_changes(
+            bitmap, BoardChanges.iter_changes(keyframe_time, next_time))
+        BoardKeyframe.add(next_time, str(bitmap))
+        g.stats.simple_event("place.history.keyframe")
+        keyframe_time = next_time
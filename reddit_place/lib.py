@@ -1,58 +1,324 @@
+from multiprocessing import cpu_count, Pool as ProcessPool
+from multiprocessing.dummy import Pool as ThreadPool
+import array
+import collections
+import os
+import sys
 import time
-import struct
 
+from pycassa.batch import Mutator
 from pylons import tmpl_context as c
 
 from r2.lib import baseplate_integration
 
-from reddit_place.models import Canvas
 from reddit_place.models import (
+    BoardChanges,
+    Canvas,
+    RedisCanvas,
+    RedisChangeLog,
+)
+from reddit_place.models import (
+    CANVAS_BITMAP_SIZE,
     CANVAS_HEIGHT,
     CANVAS_ID,
+    CANVAS_TILES_X,
     CANVAS_WIDTH,
+    PIXEL_BATCH_SIZE,
 )
+from reddit_place.history import apply_changes, get_bitmap_at, set_nibble
+from reddit_place.render import render_png
+from reddit_place.snapshot import latest_snapshot, SnapshotError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _read_canvas_colors(threads):
+    """
+    Stream every pixel out of cassandra into a bytearray of color indices.
+
+    There's one byte per pixel here, packing them into nibbles is done
+    afterwards in bulk.
+    """
+    colors = bytearray(CANVAS_WIDTH * CANVAS_HEIGHT)
+
+    def read_row(rowkey):
+        count = 0
+        for (x, y), pixel_dict in Canvas.iter_row(rowkey):
+            # These shouldn't be in cassandra but are for some reason.  The
+            # frontend only displays up to 999, 999 anyway.
+            if x >= CANVAS_WIDTH or y >= CANVAS_HEIGHT:
+                continue
+            colors[y * CANVAS_WIDTH + x] = pixel_dict['color']
+            count += 1
+        return count
+
+    count = 0
+    pool = ThreadPool(threads)
+    try:
+        for rowkeys in Canvas.read_passes():
+            count += sum(pool.imap_unordered(read_row, rowkeys))
+    finally:
+        pool.close()
+
+    return colors, count
+
+
+def pack_colors(colors):
+    """
+    Pack a bytearray of one color index per pixel into the 4-bit bitmap.
+
+    Each byte of the bitmap holds two pixels, the first in the high nibble.
+    """
+    if len(colors) % 2:
+        colors = colors + bytearray(1)
+
+    if numpy is not None:
+        unpacked = numpy.frombuffer(bytes(colors), dtype=numpy.uint8)
+        packed = (unpacked[0::2] << 4) | unpacked[1::2]
+        return packed.tostring()
+
+    # Without numpy, read the pixels two at a time as little-endian uint16s
+    # (so the first pixel is in the low byte) and look up the packed byte.
+    pairs = array.array('H', str(colors))
+    if sys.byteorder == 'big':
+        pairs.byteswap()
+    return ''.join(_PACKED_PAIRS[pair] for pair in pairs)
+
+
+_PACKED_PAIRS = {
+    (second << 8) | first: chr((first << 4) | second)
+    for first in xrange(16)
+    for second in xrange(16)
+}
 
 
-def restore_redis_board_from_cass():
+def _raise_generation(floor=0):
+    """Move the generation past any the board was served with before.
+
+    Wall clock seconds are well above the count of placements made before the
+    board was last restored, so they're used as the floor when there's
+    nothing better to go on.
+    """
+    RedisCanvas.raise_generation(max(floor, int(time.time())))
+
+
+def restore_redis_board_from_cass(threads=CANVAS_TILES_X, chunk_size=None):
     """
     Get all pixels from cassandra and put them back into redis.
+
+    Rows are streamed rather than loaded into a dict, and read in parallel
+    when the canvas is sharded.  Pass `chunk_size` to write the board to redis
+    in SETRANGE chunks instead of a single SET.
     """
     baseplate_integration.make_server_span('shell').start()
 
     # Get from cass
     st = time.time()
-    canvas = Canvas.get_all()
-    print "time to get canvas from cass: ", time.time() - st
+    colors, count = _read_canvas_colors(threads)
+    print "time to read %d pixels from cass: " % count, time.time() - st
 
     # Calculate bitmap
     st = time.time()
-    bitmap = ['\x00'] * ((CANVAS_HEIGHT * CANVAS_WIDTH + 1) / 2)
-    for (x, y), json_data in canvas.iteritems():
+    bitmap = pack_colors(colors)
+    print "time to pack bitmap for redis: ", time.time() - st
+
+    # Set to redis
+    st = time.time()
+    _raise_generation()
+    RedisCanvas.set_bitmap(bitmap, chunk_size=chunk_size)
+    # Clients can't be caught up from the change log across a restore, the
+    # board may not match what they were sent before.
+    RedisChangeLog.reset()
+    print "time to set canvas to redis: ", time.time() - st
+
 
-        # These shouldn't be in cassandra but are for some reason.  The
-        # frontend only displays up to 999, 999 anyway.
-        if x > 999 or y > 999:
-            continue
+def _read_canvas_changes_since(threads, since):
+    """
+    Stream cassandra for the pixels placed at or after `since`.
 
-        color = json_data['color']
+    Returns a list of (offset, color).
+    """
+    def read_row(rowkey):
+        changes = []
+        for (x, y), pixel_dict in Canvas.iter_row(rowkey):
+            if x >= CANVAS_WIDTH or y >= CANVAS_HEIGHT:
+                continue
+            if pixel_dict['timestamp'] >= since:
+                changes.append((y * CANVAS_WIDTH + x, pixel_dict['color']))
+        return changes
 
-        # We're putting 2 integers into a single byte.  If the integer is
-        # an odd number, we can just OR it onto the byte, since we want it
-        # at the end.  If it's an even number, it needs to go at the
-        # beginning of the byte, so we shift it first.
-        offset = y * CANVAS_WIDTH + x
-        if offset % 2 == 0:
-            color = color << 4
+    changes = []
+    pool = ThreadPool(threads)
+    try:
+        for rowkeys in Canvas.read_passes():
+            for row_changes in pool.imap_unordered(read_row, rowkeys):
+                changes.extend(row_changes)
+    finally:
+        pool.close()
 
-        # Update the color in the bitmap.  Because division rounds down, we
-        # can simply divide by 2 to find the correct byte in the bitmap.
-        bitmap_idx = offset / 2
-        updated_bitmap_int = ord(bitmap[bitmap_idx]) | color
-        packed_color = struct.pack('B', updated_bitmap_int)
-        bitmap[bitmap_idx] = packed_color
-    print "time to get generate canvas for redis: ", time.time() - st
+    return changes
+
+
+def restore_redis_board_from_snapshot(threads=CANVAS_TILES_X, chunk_size=None):
+    """
+    Load the newest board snapshot on disk and replay what was placed after.
+
+    The pixels since the snapshot come from the redis change log if it still
+    reaches back far enough, otherwise they're read from cassandra.  The log
+    only counts as reaching back if it has an entry from before the snapshot,
+    since after redis loses its data it's empty or only has newer pixels.
+    """
+    baseplate_integration.make_server_span('shell').start()
+
+    st = time.time()
+    snapshot = latest_snapshot.get()
+    if not snapshot:
+        raise SnapshotError("no board snapshot to restore from")
+    bitmap = bytearray(snapshot.bitmap.ljust(CANVAS_BITMAP_SIZE, '\x00'))
+    print "time to load snapshot from %s: " % snapshot.timestamp, time.time() - st
+
+    st = time.time()
+    changes = None
+    oldest = RedisChangeLog.get_oldest()
+    if oldest is not None and oldest <= snapshot.timestamp:
+        changes = RedisChangeLog.get_since(snapshot.timestamp)
+    if changes is not None:
+        source = "redis"
+        changes = list(RedisChangeLog.unpack(changes))
+    else:
+        source = "cass"
+        changes = _read_canvas_changes_since(threads, snapshot.timestamp)
+    for offset, color in changes:
+        set_nibble(bitmap, offset, color)
+    print "time to replay %d pixels from %s: " % (len(changes), source), \
+        time.time() - st
 
-    # Set to redis
     st = time.time()
-    c.place_redis.set(CANVAS_ID, ''.join(bitmap))
+    # every change since the snapshot moved the generation on by at least one.
+    _raise_generation(
+        RedisCanvas.get_board_generation(snapshot.board) + len(changes))
+    RedisCanvas.set_bitmap(str(bitmap), chunk_size=chunk_size)
+    # As with restoring from cassandra, clients can't be caught up from the
+    # log across the restore.
+    RedisChangeLog.reset()
     print "time to set canvas to redis: ", time.time() - st
+
+
+def _encode_raw_frame(bitmap, scale):
+    return bitmap
+
+
+# How each timelapse frame format is encoded, in the worker processes.
+TIMELAPSE_FORMATS = {
+    "raw": (_encode_raw_frame, "bitmap"),
+    "png": (render_png, "png"),
+}
+
+
+def iter_timelapse_frames(start, end, interval=10, frame_format="png",
+                          scale=1, processes=None):
+    """
+    Yield (timestamp, frame) for every `interval` seconds from start to end.
+
+    The board at `start` is rebuilt from the history keyframes, then the
+    change log is read once, in order, and applied to a single in-memory
+    bitmap, so memory use doesn't grow with the length of the history.
+    Frames are encoded by a pool of worker processes, with only a couple of
+    frames per worker in flight at once.
+    """
+    encode = TIMELAPSE_FORMATS[frame_format][0]
+    bitmap = bytearray(get_bitmap_at(start))
+
+    processes = processes or cpu_count()
+    pool = ProcessPool(processes)
+    max_pending = 2 * processes
+    pending = collections.deque()
+    try:
+        frame_time = start
+        while frame_time <= end:
+            pending.append((
+                frame_time,
+                pool.apply_async(encode, (str(bitmap), scale)),
+            ))
+            while len(pending) >= max_pending:
+                timestamp, result = pending.popleft()
+                yield timestamp, result.get()
+
+            next_time = frame_time + interval
+            apply_changes(
+                bitmap, BoardChanges.iter_changes(frame_time, next_time))
+            frame_time = next_time
+
+        while pending:
+            timestamp, result = pending.popleft()
+            yield timestamp, result.get()
+    finally:
+        pool.terminate()
+
+
+def export_timelapse(path, start, end, interval=10, frame_format="png",
+                     scale=1, processes=None):
+    """
+    Write timelapse frames of the board's history into the directory `path`.
+
+    Frames are numbered in order, e.g. frame-000000.png.
+    """
+    baseplate_integration.make_server_span('shell').start()
+
+    extension = TIMELAPSE_FORMATS[frame_format][1]
+    frames = iter_timelapse_frames(
+        start, end, interval, frame_format, scale, processes)
+
+    st = time.time()
+    count = 0
+    for count, (timestamp, frame) in enumerate(frames, 1):
+        filename = "frame-%06d.%s" % (count - 1, extension)
+        with open(os.path.join(path, filename), "wb") as f:
+            f.write(frame)
+    print "time to export %d frames: " % count, time.time() - st
+
+
+def migrate_redis_board_to_tiles():
+    """
+    Copy the single-key board in redis into per-tile keys.
+
+    Run this before turning on `place_tiled_storage`.  The original key is left
+    alone so the flag can be turned back off.
+    """
+    baseplate_integration.make_server_span('shell').start()
+
+    st = time.time()
+    bitmap = c.place_redis.get(CANVAS_ID) or ''
+    RedisCanvas.set_tiles(bitmap)
+    print "time to split canvas into tiles: ", time.time() - st
+
+
+def backfill_canvas_shards():
+    """
+    Copy every pixel in the original single canvas row into its shard row.
+
+    Run this with `place_canvas_layout = migrating` so that new pixels are
+    already being written to both, then switch to `sharded` once it's done.
+    """
+    baseplate_integration.make_server_span('shell').start()
+
+    st = time.time()
+    mutator = Mutator(
+        Canvas._cf.pool,
+        queue_size=PIXEL_BATCH_SIZE,
+        write_consistency_level=Canvas._write_consistency_level,
+    )
+    count = 0
+    columns = Canvas._cf.xget(Canvas._rowkey(), include_timestamp=True)
+    for column, (data, timestamp) in columns:
+        x, y = column
+        rowkey = Canvas._shard_rowkey_for_pixel(x, y)
+        # Keep the original timestamp so that a pixel dual-written to the
+        # shard since we read it isn't clobbered by this older copy.
+        mutator.insert(Canvas._cf, rowkey, {column: data}, timestamp=timestamp)
+        count += 1
+    mutator.send()
+    print "time to backfill %d pixels into shards: " % count, time.time() - st
@@ -1,22 +1,223 @@
 from datetime import datetime
+from multiprocessing.dummy import Pool as ThreadPool
+import array
 import json
 import struct
+import sys
 import time
+import uuid
+import zlib
 
+from pycassa.batch import Mutator
 from pycassa.system_manager import TIME_UUID_TYPE, INT_TYPE
 from pycassa.types import CompositeType, IntegerType
-from pycassa.util import convert_uuid_to_time
+from pycassa.util import convert_time_to_uuid, convert_uuid_to_time
 from pylons import app_globals as g
 from pylons import tmpl_context as c
 
+from r2.lib import amqp
 from r2.lib.db import tdb_cassandra
+from r2.lib.utils import to36
+
+from reddit_place.cache import request_memoize
+from reddit_place.degraded import backend_call
+from reddit_place.stages import stage
 
 CANVAS_ID = "real_1"
 CANVAS_WIDTH = 1000
 CANVAS_HEIGHT = 1000
+CANVAS_TILE_SIZE = 100
+CANVAS_TILES_X = CANVAS_WIDTH / CANVAS_TILE_SIZE
+CANVAS_TILES_Y = CANVAS_HEIGHT / CANVAS_TILE_SIZE
+# Each pixel is 4 bits, so a byte holds two of them.
+CANVAS_BITMAP_SIZE = (CANVAS_WIDTH * CANVAS_HEIGHT + 1) / 2
+TILE_ROW_SIZE = CANVAS_TILE_SIZE / 2
+TILE_BITMAP_SIZE = CANVAS_TILE_SIZE * TILE_ROW_SIZE
+# The board-bitmap response starts with the time it was read and the board's
+# generation, which goes up by at least one with every change to the board.
+BOARD_HEADER = struct.Struct("<II")
+# How many rows worth of writes to send to cassandra in each batch_mutate.
+PIXEL_BATCH_SIZE = 200
+# How many columns to fetch at a time when streaming a whole Canvas row.
+ROW_BUFFER_SIZE = 4096
+# Seconds of placements per BoardChanges row, and between board keyframes.
+HISTORY_INTERVAL = 300
+# How long the pixel inspector's view of a cell is cached for.
+PIXEL_CACHE_PREFIX = "place:pixel:"
+PIXEL_CACHE_TTL = 30
+# Compact Canvas and PixelsByParticipant columns start with a version byte.
+# Old JSON columns always start with "{", so the two can be told apart.
+PIXEL_COLUMN_VERSION = 1
+CANVAS_COLUMN = struct.Struct("<BBdQ")  # version, color, timestamp, user id
+PARTICIPANT_COLUMN = struct.Struct("<BBHH")  # version, color, x, y
+USERNAME_SHARDS = 64
+# Pixels waiting to be written to cassandra, with place_write_behind on.
+PIXEL_WRITE_QUEUE = "place_pixel_writes_q"
+PIXEL_COOLDOWN_SECONDS = 300
+# Placements are allowed this many seconds before the cooldown is up, to allow
+# for clock differences between the client and server.
+PIXEL_COOLDOWN_GRACE_SECONDS = 2
+ADMIN_RECT_DRAW_MAX_SIZE = 20
 
 
 class RedisCanvas(object):
+    """The live state of the board, stored as 4-bit colors in redis.
+
+    By default the whole canvas is kept in a single string at `CANVAS_ID`.
+    With `place_tiled_storage` enabled it is instead split into
+    CANVAS_TILE_SIZE x CANVAS_TILE_SIZE tiles, each in its own key, so that
+    setting a pixel only dirties one small value and reading a tile doesn't
+    need to touch the rest of the board.
+
+    Every write to the board also increments the counter at GENERATION_KEY in
+    the same transaction, so two reads of the board with the same generation
+    are guaranteed to have the same contents.
+
+    """
+
+    GENERATION_KEY = CANVAS_ID + ":generation"
+
+    @classmethod
+    def _is_tiled(cls):
+        return getattr(g, "place_tiled_storage", False)
+
+    @classmethod
+    def _tile_key(cls, tx, ty):
+        return "%s:tile:%d:%d" % (CANVAS_ID, tx, ty)
+
+    @classmethod
+    def _tile_keys(cls):
+        return [
+            cls._tile_key(tx, ty)
+            for ty in xrange(CANVAS_TILES_Y)
+            for tx in xrange(CANVAS_TILES_X)
+        ]
+
+    @classmethod
+    def _locate(cls, x, y):
+        """Return the redis key and the u4 offset within it for (x, y)."""
+        if cls._is_tiled():
+            tx, tile_x = divmod(x, CANVAS_TILE_SIZE)
+            ty, tile_y = divmod(y, CANVAS_TILE_SIZE)
+            return cls._tile_key(tx, ty), tile_y * CANVAS_TILE_SIZE + tile_x
+        return CANVAS_ID, y * CANVAS_WIDTH + x
+
+    @classmethod
+    def _board_offset(cls, tx, ty, row):
+        """Byte offset in the full bitmap of a row of the tile (tx, ty)."""
+        y = ty * CANVAS_TILE_SIZE + row
+        x = tx * CANVAS_TILE_SIZE
+        return (y * CANVAS_WIDTH + x) / 2
+
+    @classmethod
+    def get_generation(cls):
+        return int(c.place_redis.get(cls.GENERATION_KEY) or 0)
+
+    @classmethod
+    def raise_generation(cls, floor):
+        """Make sure the generation is at least `floor`.
+
+        The generation only lives in redis, so if redis loses it the count
+        starts over and reuses generations that clients have already seen.
+
+        """
+
+        current = cls.get_generation()
+        if current < floor:
+            # an INCRBY rather than a SET, so placements made since we read
+            # the generation still move it forward.
+            c.place_redis.incr(cls.GENERATION_KEY, floor - current)
+
+    @classmethod
+    def get_bitmap(cls):
+        """Return the raw 4-bit packed bitmap of the whole board."""
+        return cls.get_bitmap_and_generation()[0]
+
+    @classmethod
+    def get_bitmap_and_generation(cls):
+        """Return the bitmap of the whole board and its generation.
+
+        Both are read with a single MGET so they always match.
+
+        """
+
+        if not cls._is_tiled():
+            generation, bitmap = c.place_redis.mget(
+                [cls.GENERATION_KEY, CANVAS_ID])
+            # If no pixels have been placed yet, we'll get back None.
+            return bitmap or '', int(generation or 0)
+
+        values = c.place_redis.mget([cls.GENERATION_KEY] + cls._tile_keys())
+        generation, tiles = int(values[0] or 0), values[1:]
+        bitmap = bytearray(CANVAS_BITMAP_SIZE)
+        for i, tile in enumerate(tiles):
+            if not tile:
+                continue
+            ty, tx = divmod(i, CANVAS_TILES_X)
+            for row in xrange(CANVAS_TILE_SIZE):
+                start = row * TILE_ROW_SIZE
+                chunk = tile[start:start + TILE_ROW_SIZE]
+                if not chunk:
+                    break
+                offset = cls._board_offset(tx, ty, row)
+                bitmap[offset:offset + len(chunk)] = chunk
+        return str(bitmap), generation
+
+    @classmethod
+    def set_bitmap(cls, bitmap, chunk_size=None):
+        """Replace the whole board with a raw 4-bit packed bitmap.
+
+        With `chunk_size` the bitmap is written with a SETRANGE per chunk
+        rather than one big SET, so redis can serve other clients between
+        them.
+
+        """
+
+        if cls._is_tiled():
+            cls.set_tiles(bitmap)
+        elif chunk_size:
+            for offset in xrange(0, len(bitmap), chunk_size):
+                c.place_redis.setrange(
+                    CANVAS_ID, offset, bitmap[offset:offset + chunk_size])
+            c.place_redis.incr(cls.GENERATION_KEY)
+        else:
+            pipe = c.place_redis.pipeline(transaction=True)
+            pipe.set(CANVAS_ID, bitmap)
+            pipe.incr(cls.GENERATION_KEY)
+            pipe.execute()
+
+    @classmethod
+    def set_tiles(cls, bitmap):
+        """Split a raw board bitmap up and write it out as per-tile keys."""
+        bitmap = bitmap.ljust(CANVAS_BITMAP_SIZE, '\x00')
+        tiles = {}
+        for ty in xrange(CANVAS_TILES_Y):
+            for tx in xrange(CANVAS_TILES_X):
+                rows = []
+                for row in xrange(CANVAS_TILE_SIZE):
+                    offset = cls._board_offset(tx, ty, row)
+                    rows.append(bitmap[offset:offset + TILE_ROW_SIZE])
+                tiles[cls._tile_key(tx, ty)] = ''.join(rows)
+
+        pipe = c.place_redis.pipeline(transaction=True)
+        pipe.mset(tiles)
+        pipe.incr(cls.GENERATION_KEY)
+        pipe.execute()
+
+    @classmethod
+    def get_tile_bitmap(cls, tx, ty):
+        """Return the raw 4-bit packed bitmap of a single tile."""
+        if cls._is_tiled():
+            tile = c.place_redis.get(cls._tile_key(tx, ty)) or ''
+            return tile.ljust(TILE_BITMAP_SIZE, '\x00')
+
+        # Each row of the tile is a separate range of the board string.
+        pipe = c.place_redis.pipeline(transaction=False)
+        for row in xrange(CANVAS_TILE_SIZE):
+            offset = cls._board_offset(tx, ty, row)
+            pipe.getrange(CANVAS_ID, offset, offset + TILE_ROW_SIZE - 1)
+        rows = pipe.execute()
+        return ''.join((row or '').ljust(TILE_ROW_SIZE, '\x00') for row in rows)
 
     @classmethod
     def get_board(cls):
@@ -24,15 +225,32 @@ class RedisCanvas(object):
         # timestamp as a 32 bit uint at the beginning so the client can make a
         # determination as to whether the cached state is too old.  If it's too
         # old, the client will hit the non-fastly-cached endpoint directly.
+        # The generation after it identifies the contents for revalidation.
+        timestamp = time.time()
+        bitmap, generation = cls.get_bitmap_and_generation()
+        return BOARD_HEADER.pack(int(timestamp), generation) + bitmap
+
+    @classmethod
+    def get_board_generation(cls, board):
+        """Return the generation from the header of a get_board response."""
+        return BOARD_HEADER.unpack_from(board)[1]
+
+    @classmethod
+    def get_tile(cls, tx, ty):
+        # Tiles carry the same timestamp header as the full board so that
+        # each one can be cached (and judged too old) independently.
         timestamp = time.time()
-        # If no pixels have been placed yet, we'll get back None.  This will
-        # cause concatenation to fail below, so we turn it into a string
-        # instead.
-        bitmap = c.place_redis.get(CANVAS_ID) or ''
+        bitmap = cls.get_tile_bitmap(tx, ty)
         return struct.pack('I', int(timestamp)) + bitmap
 
     @classmethod
     def set_pixel(cls, color, x, y):
+        return cls.set_pixels([(color, x, y)])
+
+    @classmethod
+    def set_pixels(cls, placements):
+        """Set (color, x, y) placements and return the new generation."""
+
         # The canvas is stored in one long redis bitfield, offset by the
         # coordinates of the pixel.  For instance, for a canvas of width 1000,
         # the offset for position (1, 1) would be 1001.  redis conveniently
@@ -42,11 +260,247 @@ class RedisCanvas(object):
         #
         #     https://redis.io/commands/bitfield
         #
+        # With tiled storage the same applies, just within the tile's key.
+        # BITFIELD takes any number of operations, so we send a single command
+        # per key no matter how many pixels are being set, all in one
+        # transaction with the generation bump.
         UINT_SIZE = 'u4'  # Max value: 15
+        ops_by_key = {}
+        for color, x, y in placements:
+            key, offset = cls._locate(x, y)
+            ops_by_key.setdefault(key, []).extend(
+                ('SET', UINT_SIZE, '#%d' % offset, color))
+
+        pipe = c.place_redis.pipeline(transaction=True)
+        for key, ops in ops_by_key.iteritems():
+            pipe.execute_command('bitfield', key, *ops)
+        pipe.incr(cls.GENERATION_KEY)
+        return pipe.execute()[-1]
+
+
+class RedisChangeLog(object):
+    """A bounded, ordered log of recent placements.
+
+    Each placement is stored in a sorted set scored by its timestamp, as a
+    little-endian uint32 of `offset << 4 | color`.  Since the member is just
+    the position and color, placing the same color twice in the same spot
+    only moves the existing entry forward in time, which is still correct
+    when the log is replayed in order.
+
+    Clients that lost their websocket connection can ask for everything since
+    the timestamp of the last board state they saw instead of downloading the
+    whole board again.
+
+    """
+
+    KEY = CANVAS_ID + ":changes"
+    # Changes before this time are known to be missing from the log, e.g.
+    # because the board was restored from cassandra.  Only reset() sets it,
+    # so if redis loses it along with the log nothing is trusted.
+    HORIZON_KEY = CANVAS_ID + ":changes_horizon"
+    MAX_LENGTH = 100000
+
+    @classmethod
+    def pack(cls, color, x, y):
         offset = y * CANVAS_WIDTH + x
-        c.place_redis.execute_command(
-            'bitfield', CANVAS_ID, 'SET',
-            UINT_SIZE, '#%d' % offset, color)
+        return struct.pack('<I', offset << 4 | color)
+
+    @classmethod
+    def unpack(cls, changes):
+        """Yield (offset, color) for each packed change."""
+        records = array.array('I', changes)
+        if sys.byteorder == 'big':
+            records.byteswap()
+        for record in records:
+            yield record >> 4, record & 15
+
+    @classmethod
+    def append(cls, placements):
+        """Append (color, x, y, timestamp) placements to the log."""
+        pipe = c.place_redis.pipeline(transaction=False)
+        for color, x, y, timestamp in placements:
+            pipe.execute_command(
+                'zadd', cls.KEY, timestamp, cls.pack(color, x, y))
+        pipe.zremrangebyrank(cls.KEY, 0, -(cls.MAX_LENGTH + 1))
+        pipe.execute()
+
+    @classmethod
+    def reset(cls):
+        """Mark everything currently in the log as unreliable.
+
+        The log isn't used at all until this has been called once.
+
+        """
+        c.place_redis.set(cls.HORIZON_KEY, time.time())
+
+    @classmethod
+    def get_oldest(cls):
+        """Return the timestamp of the oldest change in the log, or None."""
+        oldest = c.place_redis.zrange(cls.KEY, 0, 0, withscores=True)
+        if not oldest:
+            return None
+        return oldest[0][1]
+
+    @classmethod
+    def get_since(cls, since):
+        """Return the packed changes made at or after `since`.
+
+        Returns None if the log doesn't reach back that far, in which case the
+        caller needs to fetch the full board instead.
+
+        """
+
+        pipe = c.place_redis.pipeline(transaction=False)
+        pipe.get(cls.HORIZON_KEY)
+        pipe.zcard(cls.KEY)
+        pipe.zrange(cls.KEY, 0, 0, withscores=True)
+        pipe.zrangebyscore(cls.KEY, since, '+inf')
+        horizon, length, oldest, changes = pipe.execute()
+
+        if horizon is None:
+            # never reset, or redis lost it, so we can't tell what's missing.
+            return None
+
+        horizon = float(horizon)
+        if length >= cls.MAX_LENGTH and oldest:
+            # the log has been trimmed, so it's only complete from its
+            # oldest remaining entry onwards.
+            horizon = max(horizon, oldest[0][1])
+
+        if since < horizon:
+            return None
+
+        return ''.join(changes)
+
+    @classmethod
+    def get_delta(cls, since):
+        # Stamp the response with the time before reading so that anything
+        # placed while we read is included in the client's next request.
+        timestamp = time.time()
+        changes = cls.get_since(since)
+        if changes is None:
+            return None
+        return struct.pack('I', int(timestamp)) + changes
+
+
+class RedisCooldown(object):
+    """The time of each user's last placement, cached in redis.
+
+    Keys outlive the cooldown itself by a good margin so that a missing key
+    means we don't know when the user last placed, rather than that their
+    cooldown is over.  Only then do we need to go to cassandra.
+
+    """
+
+    KEY_TTL = 3600
+
+    @classmethod
+    def _key(cls, user):
+        return "%s:last_placement:%s" % (CANVAS_ID, user._fullname)
+
+    @classmethod
+    def get(cls, user):
+        """Return the timestamp of the user's last placement, or None.
+
+        A user known to have never placed anything has a timestamp of 0.
+
+        """
+
+        timestamp = c.place_redis.get(cls._key(user))
+        if timestamp is None:
+            return None
+        return float(timestamp)
+
+    @classmethod
+    def set(cls, user, timestamp, only_if_missing=False):
+        c.place_redis.set(
+            cls._key(user), timestamp, ex=cls.KEY_TTL, nx=only_if_missing)
+
+
+class RedisPlacement(object):
+    """Places a pixel for a user in a single atomic redis script.
+
+    The script checks the user's cooldown, sets the pixel, appends it to the
+    change log and starts the new cooldown, so there's no gap between the
+    check and the placement for a second request to slip through, and the
+    whole thing is one round trip.
+
+    """
+
+    # KEYS: cooldown, canvas, change log, board generation
+    # ARGV: timestamp, min interval, cooldown, cooldown ttl, offset, color,
+    #       packed change, change log length
+    #
+    # Returns {1, generation} if placed, {0, wait seconds} if the user has to
+    # wait, or {-1} if nothing is cached about when the user last placed.
+    SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local previous = redis.call('GET', KEYS[1])
+        if not previous then
+            return {-1}
+        end
+        previous = tonumber(previous)
+        if previous + tonumber(ARGV[2]) > now then
+            return {0, tostring(previous + tonumber(ARGV[3]) - now)}
+        end
+
+        redis.call('BITFIELD', KEYS[2], 'SET', 'u4', '#' .. ARGV[5], ARGV[6])
+        redis.call('ZADD', KEYS[3], ARGV[1], ARGV[7])
+        redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -(tonumber(ARGV[8]) + 1))
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[4])
+        return {1, redis.call('INCR', KEYS[4])}
+    """
+    _script = None
+
+    @classmethod
+    def place(cls, user, color, x, y, timestamp, cooldown, grace=0):
+        """Place the pixel if the user's cooldown has passed.
+
+        Returns (wait seconds, generation).  The wait is 0 if the pixel was
+        placed, in which case the generation is the board's new generation,
+        or None if the user's last placement isn't cached.
+
+        """
+
+        if cls._script is None:
+            cls._script = c.place_redis.register_script(cls.SCRIPT)
+
+        key, offset = RedisCanvas._locate(x, y)
+        with stage("redis_place"), backend_call("redis"):
+            result = cls._script(
+                keys=[
+                    RedisCooldown._key(user),
+                    key,
+                    RedisChangeLog.KEY,
+                    RedisCanvas.GENERATION_KEY,
+                ],
+                args=[
+                    repr(timestamp),
+                    cooldown - grace,
+                    cooldown,
+                    RedisCooldown.KEY_TTL,
+                    offset,
+                    color,
+                    RedisChangeLog.pack(color, x, y),
+                    RedisChangeLog.MAX_LENGTH,
+                ],
+                client=c.place_redis,
+            )
+
+        if result[0] == -1:
+            return None, None
+        elif result[0] == 0:
+            return float(result[1]), None
+        return 0, result[1]
+
+
+def _pixel_cache_key(x, y):
+    return "%d_%d" % (x, y)
+
+
+def _write_timestamp(pixel):
+    """The cassandra column timestamp, in microseconds, for a pixel's writes."""
+    return int(convert_uuid_to_time(pixel._id) * 1000000)
 
 
 class Pixel(tdb_cassandra.UuidThing):
@@ -63,11 +517,82 @@ class Pixel(tdb_cassandra.UuidThing):
 
     @classmethod
     def create(cls, user, color, x, y):
+        return cls.create_many(user, [(color, x, y)])[0]
 
-        # We dual-write to cassandra to allow the frontend to get information
-        # on a particular pixel, as well as to have a backup, persistent state
-        # of the board in case something goes wrong with redis.
-        pixel = cls(
+    @classmethod
+    def create_many(cls, user, placements):
+        """Create a pixel for each (color, x, y) in `placements`.
+
+        All of the cassandra writes go out through one batch mutator and all
+        of the redis updates in a single BITFIELD per key, so this costs about
+        the same number of round trips whether it's one pixel or hundreds.
+
+        With `place_write_behind` on, redis is updated first and the
+        cassandra writes are queued on PIXEL_WRITE_QUEUE for the
+        place_pixel_writes_q consumer rather than waited on.
+
+        Each pixel's `_generation` is set to the board generation it was
+        placed in.
+
+        """
+
+        pixels = [cls._new(user, color, x, y) for color, x, y in placements]
+
+        if getattr(g, "place_write_behind", False):
+            cls._update_redis(user, pixels)
+            cls.queue_writes(pixels)
+        else:
+            # We dual-write to cassandra to allow the frontend to get
+            # information on a particular pixel, as well as to have a backup,
+            # persistent state of the board in case something goes wrong with
+            # redis.
+            cls.write_pixels(pixels)
+            cls._update_redis(user, pixels)
+
+        g.stats.simple_event('place.pixel.create', delta=len(pixels))
+
+        return pixels
+
+    @classmethod
+    def place(cls, user, color, x, y, cooldown, grace=0):
+        """Place a pixel for a user, if their cooldown allows it.
+
+        Redis is updated by RedisPlacement in one round trip, and only then
+        is the pixel written (or queued to be written) to cassandra.  Returns
+        the same as RedisPlacement.place.
+
+        The pixel is already on the board and the cooldown spent by the time
+        cassandra is written, so if that write fails the pixel is queued for
+        the write-behind consumer instead of failing the placement.
+
+        """
+
+        pixel = cls._new(user, color, x, y)
+        wait_seconds, generation = RedisPlacement.place(
+            user, color, x, y, convert_uuid_to_time(pixel._id), cooldown,
+            grace)
+        if wait_seconds != 0:
+            return wait_seconds, None
+
+        if getattr(g, "place_write_behind", False):
+            cls.queue_writes([pixel])
+        else:
+            try:
+                cls.write_pixels([pixel])
+            except Exception as e:
+                g.log.warning(
+                    "place: queueing pixel after cassandra write failed: %s",
+                    e)
+                g.stats.simple_event("place.pixel.write_failed")
+                cls.queue_writes([pixel])
+
+        g.stats.simple_event('place.pixel.create')
+
+        return 0, generation
+
+    @classmethod
+    def _new(cls, user, color, x, y):
+        return cls(
             canvas_id=CANVAS_ID,
             user_name=user.name if user else '',
             user_fullname=user._fullname if user else '',
@@ -75,36 +600,329 @@ class Pixel(tdb_cassandra.UuidThing):
             x=x,
             y=y,
         )
-        pixel._commit()
 
-        Canvas.insert_pixel(pixel)
+    @classmethod
+    def _update_redis(cls, user, pixels):
+        with stage("redis_update"), backend_call("redis"):
+            generation = RedisCanvas.set_pixels(
+                [(pixel.color, pixel.x, pixel.y) for pixel in pixels])
+            # not a column, just so callers can tell clients about it.
+            for pixel in pixels:
+                pixel._generation = generation
 
-        if user:
-            PixelsByParticipant.add(user, pixel)
+            RedisChangeLog.append([
+                (pixel.color, pixel.x, pixel.y,
+                 convert_uuid_to_time(pixel._id))
+                for pixel in pixels
+            ])
+            if user:
+                RedisCooldown.set(user, convert_uuid_to_time(pixels[-1]._id))
 
-        RedisCanvas.set_pixel(color, x, y)
+    @classmethod
+    def write_pixels(cls, pixels):
+        """Write pixels to every cassandra view they belong in.
 
-        g.stats.simple_event('place.pixel.create')
+        Columns are written with the time the pixel was placed as their
+        timestamp, so writing the same pixel again, or an older pixel after a
+        newer one, never changes what's stored.
+
+        """
+
+        with stage("cassandra_write"), backend_call("cassandra"):
+            mutator = Mutator(
+                cls._cf.pool,
+                queue_size=PIXEL_BATCH_SIZE,
+                write_consistency_level=cls._write_consistency_level,
+            )
+            users = {}
+            for pixel in pixels:
+                pixel._queue_commit(mutator)
+                Canvas.queue_pixel(mutator, pixel)
+                BoardChanges.queue_pixel(mutator, pixel)
+                if pixel.user_fullname:
+                    PixelsByParticipant.queue_pixel(mutator, pixel)
+                    users[_user_id(pixel.user_fullname)] = pixel.user_name
+
+            compact = _use_compact_columns()
+            if compact:
+                for user_id, user_name in users.iteritems():
+                    PlaceUsernames.queue_user(mutator, user_id, user_name)
+            mutator.send()
+            for pixel in pixels:
+                pixel._mark_committed()
+            if compact:
+                PlaceUsernames.remember_users(users)
 
+            g.cache.delete_multi(
+                [_pixel_cache_key(pixel.x, pixel.y) for pixel in pixels],
+                prefix=PIXEL_CACHE_PREFIX,
+            )
+
+    @classmethod
+    def queue_writes(cls, pixels):
+        """Queue pixels to be written to cassandra by the consumer."""
+        with stage("queue_write"):
+            for pixel in pixels:
+                amqp.add_item(PIXEL_WRITE_QUEUE, json.dumps({
+                    "id": str(pixel._id),
+                    "user_name": pixel.user_name,
+                    "user_fullname": pixel.user_fullname,
+                    "color": pixel.color,
+                    "x": pixel.x,
+                    "y": pixel.y,
+                }))
+
+    @classmethod
+    def from_queued_write(cls, body):
+        """Rebuild a pixel queued by queue_writes."""
+        pixel_dict = json.loads(body)
+        pixel = cls(
+            canvas_id=CANVAS_ID,
+            user_name=pixel_dict["user_name"],
+            user_fullname=pixel_dict["user_fullname"],
+            color=pixel_dict["color"],
+            x=pixel_dict["x"],
+            y=pixel_dict["y"],
+        )
+        pixel._id = uuid.UUID(pixel_dict["id"])
         return pixel
 
+    def _queue_commit(self, mutator):
+        """Add this new pixel's columns to a batch instead of _commit-ing."""
+        columns = {
+            "canvas_id": self.canvas_id,
+            "user_name": self.user_name,
+            "user_fullname": self.user_fullname,
+        }
+        # names rebuilt from a queued write come back as unicode.
+        columns = {
+            attr: val.encode("utf-8") if isinstance(val, unicode) else val
+            for attr, val in columns.iteritems()
+        }
+        columns.update(
+            color=str(self.color),
+            x=str(self.x),
+            y=str(self.y),
+        )
+        mutator.insert(
+            self._cf, self._id, columns, timestamp=_write_timestamp(self))
+
+    def _mark_committed(self):
+        """Do what _commit does once the queued columns have been sent."""
+        self._orig.update(self._dirties)
+        self._dirties.clear()
+        self._committed = True
+
     @classmethod
     def get_last_placement_datetime(cls, user):
         return PixelsByParticipant.get_last_pixel_datetime(user)
 
+    @classmethod
+    def get_last_placement_timestamp(cls, user):
+        return PixelsByParticipant.get_last_pixel_timestamp(user)
+
     @classmethod
     def get_pixel_at(cls, x, y):
-        pixel_dict = Canvas.get(x, y)
-        if not pixel_dict:
-            return None
+        return cls.get_pixels_in(x, y, x, y).get((x, y))
 
-        return dict(
-            user_name=pixel_dict["user_name"],
-            color=pixel_dict["color"],
-            x=x,
-            y=y,
-            timestamp=pixel_dict["timestamp"],
-        )
+    @classmethod
+    def get_pixels_in(cls, x0, y0, x1, y1):
+        """Return dict of (x,y) -> pixel info for the inclusive rectangle.
+
+        Recently read cells are cached for PIXEL_CACHE_TTL seconds, and
+        whatever isn't cached is read from cassandra in a single region read.
+        Placing a pixel drops it from the cache.
+
+        """
+
+        keys = {
+            _pixel_cache_key(x, y): (x, y)
+            for x in xrange(x0, x1 + 1)
+            for y in xrange(y0, y1 + 1)
+        }
+        cached = g.cache.get_multi(keys.keys(), prefix=PIXEL_CACHE_PREFIX)
+        g.stats.simple_event("place.pixel_cache.hit", delta=len(cached))
+
+        missing = [keys[key] for key in keys if key not in cached]
+        if missing:
+            g.stats.simple_event(
+                "place.pixel_cache.miss", delta=len(missing))
+            xs, ys = zip(*missing)
+            region = Canvas.get_region(min(xs), min(ys), max(xs), max(ys))
+
+            # cells without a pixel are cached as empty dicts so they don't
+            # keep missing.
+            to_cache = {}
+            for x, y in missing:
+                pixel_dict = region.get((x, y))
+                if pixel_dict:
+                    to_cache[_pixel_cache_key(x, y)] = dict(
+                        user_name=pixel_dict["user_name"],
+                        color=pixel_dict["color"],
+                        x=x,
+                        y=y,
+                        timestamp=pixel_dict["timestamp"],
+                    )
+                else:
+                    to_cache[_pixel_cache_key(x, y)] = {}
+            g.cache.set_multi(
+                to_cache, prefix=PIXEL_CACHE_PREFIX, time=PIXEL_CACHE_TTL)
+            cached.update(to_cache)
+
+        return {keys[key]: pixel for key, pixel in cached.iteritems() if pixel}
+
+
+def get_last_placement_timestamp(user):
+    timestamp = RedisCooldown.get(user)
+    if timestamp is None:
+        g.stats.simple_event("place.cooldown.miss")
+        with stage("cooldown_read"), backend_call("cassandra"):
+            timestamp = Pixel.get_last_placement_timestamp(user) or 0
+        # Don't clobber a placement that raced us while we read cassandra.
+        RedisCooldown.set(user, timestamp, only_if_missing=True)
+    else:
+        g.stats.simple_event("place.cooldown.hit")
+    return timestamp
+
+
+@request_memoize("place.wait_seconds")
+def get_wait_seconds(user):
+    last_pixel_timestamp = get_last_placement_timestamp(user)
+    now = time.time()
+
+    if last_pixel_timestamp + PIXEL_COOLDOWN_SECONDS > now:
+        wait_seconds = last_pixel_timestamp + PIXEL_COOLDOWN_SECONDS - now
+    else:
+        wait_seconds = 0
+
+    return wait_seconds
+
+
+def place_pixel(user, color, x, y):
+    """Place a pixel if the user's cooldown allows it.
+
+    Returns the seconds left to wait, or 0 if the pixel was placed, and the
+    board generation it was placed in.
+
+    """
+
+    wait_seconds, generation = Pixel.place(
+        user, color, x, y, PIXEL_COOLDOWN_SECONDS, PIXEL_COOLDOWN_GRACE_SECONDS)
+    if wait_seconds is None:
+        # nothing cached about the user's last placement, fill it in from
+        # cassandra and try again.
+        get_last_placement_timestamp(user)
+        wait_seconds, generation = Pixel.place(
+            user, color, x, y, PIXEL_COOLDOWN_SECONDS,
+            PIXEL_COOLDOWN_GRACE_SECONDS)
+
+    if wait_seconds is None:
+        # the cached timestamp expired again already, have them retry.
+        g.stats.simple_event("place.cooldown.lost_race")
+        wait_seconds = PIXEL_COOLDOWN_GRACE_SECONDS
+    return wait_seconds, generation
+
+
+def _use_compact_columns():
+    return getattr(g, "place_compact_columns", False)
+
+
+def _user_id(user_fullname):
+    if not user_fullname:
+        return 0
+    return int(user_fullname.split("_", 1)[1], 36)
+
+
+def unpack_canvas_column(data):
+    """Decode a Canvas column, in either the JSON or the compact format.
+
+    Compact columns only have the author's id, `user_name` is left as None
+    for resolve_user_names to fill in.
+
+    """
+
+    if data.startswith("{"):
+        pixel_dict = json.loads(data)
+        pixel_dict["user_id"] = _user_id(pixel_dict["user_fullname"])
+        return pixel_dict
+
+    version, color, timestamp, user_id = CANVAS_COLUMN.unpack(data)
+    if version != PIXEL_COLUMN_VERSION:
+        raise ValueError("unknown canvas column version %d" % version)
+    return {
+        "color": color,
+        "timestamp": timestamp,
+        "user_id": user_id,
+        "user_name": None,
+        "user_fullname": "t2_" + to36(user_id) if user_id else "",
+    }
+
+
+def resolve_user_names(pixel_dicts):
+    """Fill in `user_name` on pixel dicts read from compact columns."""
+    unresolved = [
+        pixel_dict for pixel_dict in pixel_dicts
+        if pixel_dict["user_name"] is None
+    ]
+    if not unresolved:
+        return
+
+    names = PlaceUsernames.get_names(
+        {pixel_dict["user_id"] for pixel_dict in unresolved})
+    for pixel_dict in unresolved:
+        pixel_dict["user_name"] = names.get(pixel_dict["user_id"], "")
+
+
+class PlaceUsernames(tdb_cassandra.View):
+    """
+    Interned usernames for compact pixel columns, by account id.
+
+    Ids are spread over USERNAME_SHARDS rows so no one row gets too big.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+    _compare_with = IntegerType()
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    # Ids this process has already written, so each name is usually only
+    # written the first time its user places a pixel.
+    _known_ids = set()
+    MAX_KNOWN_IDS = 100000
+
+    @classmethod
+    def _rowkey(cls, user_id):
+        return "%s_users_%d" % (CANVAS_ID, user_id % USERNAME_SHARDS)
+
+    @classmethod
+    def queue_user(cls, mutator, user_id, user_name):
+        if user_id in cls._known_ids:
+            return
+
+        mutator.insert(cls._cf, cls._rowkey(user_id), {user_id: user_name})
+
+    @classmethod
+    def remember_users(cls, user_ids):
+        """Note that these users' names have been written."""
+        if len(cls._known_ids) >= cls.MAX_KNOWN_IDS:
+            cls._known_ids.clear()
+        cls._known_ids.update(user_ids)
+
+    @classmethod
+    def get_names(cls, user_ids):
+        """Return dict of user id -> name."""
+        user_ids = [user_id for user_id in user_ids if user_id]
+        if not user_ids:
+            return {}
+
+        rowkeys = {cls._rowkey(user_id) for user_id in user_ids}
+        rows = cls._cf.multiget(list(rowkeys), columns=user_ids)
+        names = {}
+        for row in rows.itervalues():
+            names.update(row)
+        return names
 
 
 class PixelsByParticipant(tdb_cassandra.View):
@@ -117,22 +935,38 @@ class PixelsByParticipant(tdb_cassandra.View):
 
     @classmethod
     def _rowkey(cls, user):
-        return CANVAS_ID + "_ " + user._fullname
+        return cls._rowkey_for_fullname(user._fullname)
 
     @classmethod
-    def add(cls, user, pixel):
-        rowkey = cls._rowkey(user)
+    def _rowkey_for_fullname(cls, user_fullname):
+        return CANVAS_ID + "_ " + user_fullname
+
+    @classmethod
+    def _columns(cls, pixel):
+        if _use_compact_columns():
+            # the user is already in the rowkey.
+            return {pixel._id: PARTICIPANT_COLUMN.pack(
+                PIXEL_COLUMN_VERSION, pixel.color, pixel.x, pixel.y)}
+
         pixel_dict = {
             "user_fullname": pixel.user_fullname,
             "color": pixel.color,
             "x": pixel.x,
             "y": pixel.y,
         }
-        columns = {pixel._id: json.dumps(pixel_dict)}
-        cls._cf.insert(rowkey, columns)
+        return {pixel._id: json.dumps(pixel_dict)}
 
     @classmethod
-    def get_last_pixel_datetime(cls, user):
+    def queue_pixel(cls, mutator, pixel):
+        mutator.insert(
+            cls._cf,
+            cls._rowkey_for_fullname(pixel.user_fullname),
+            cls._columns(pixel),
+            timestamp=_write_timestamp(pixel),
+        )
+
+    @classmethod
+    def get_last_pixel_timestamp(cls, user):
         rowkey = cls._rowkey(user)
         try:
             columns = cls._cf.get(rowkey, column_count=1, column_reversed=True)
@@ -140,7 +974,13 @@ class PixelsByParticipant(tdb_cassandra.View):
             return None
 
         u = columns.keys()[0]
-        ts = convert_uuid_to_time(u)
+        return convert_uuid_to_time(u)
+
+    @classmethod
+    def get_last_pixel_datetime(cls, user):
+        ts = cls.get_last_pixel_timestamp(user)
+        if ts is None:
+            return None
         return datetime.utcfromtimestamp(ts).replace(tzinfo=g.tz)
 
 
@@ -151,21 +991,76 @@ class Canvas(tdb_cassandra.View):
 
 
     """
-    Super naive storage for the canvas, everything's in a single row.
+    Storage for the canvas, with one column per pixel.
+
+    Originally everything was in a single row, which made that row a hot
+    partition and meant reading the whole board was a single-row scan.  Pixels
+    are now sharded across one row per CANVAS_TILE_SIZE square tile, which
+    spreads them around the ring and lets regions be read without touching
+    the rest of the board.
 
-    In the future we may want to break it up so that each C* row contains only
-    a subset of all rows. That would spread the data out in the ring and
-    would make it easy to grab regions of the canvas.
+    `place_canvas_layout` controls which rows are used while migrating:
+
+        single - read and write only the original row
+        migrating - write both, read the shards and fall back to the original
+            row for anything that hasn't been backfilled yet
+        sharded - read and write only the shards
 
     """
 
+    SINGLE = "single"
+    MIGRATING = "migrating"
+    SHARDED = "sharded"
+
+    @classmethod
+    def _layout(cls):
+        return getattr(g, "place_canvas_layout", cls.SINGLE)
+
     @classmethod
     def _rowkey(cls):
         return CANVAS_ID
 
     @classmethod
-    def insert_pixel(cls, pixel):
-        columns = {
+    def _shard_rowkey(cls, tx, ty):
+        return "%s_%d_%d" % (CANVAS_ID, tx, ty)
+
+    @classmethod
+    def _shard_rowkey_for_pixel(cls, x, y):
+        return cls._shard_rowkey(x / CANVAS_TILE_SIZE, y / CANVAS_TILE_SIZE)
+
+    @classmethod
+    def _shard_rowkeys(cls, x0=0, y0=0, x1=CANVAS_WIDTH - 1,
+                       y1=CANVAS_HEIGHT - 1):
+        return [
+            cls._shard_rowkey(tx, ty)
+            for ty in xrange(y0 / CANVAS_TILE_SIZE, y1 / CANVAS_TILE_SIZE + 1)
+            for tx in xrange(x0 / CANVAS_TILE_SIZE, x1 / CANVAS_TILE_SIZE + 1)
+        ]
+
+    @classmethod
+    def _write_rowkeys(cls, x, y):
+        layout = cls._layout()
+        rowkeys = []
+        if layout != cls.SHARDED:
+            rowkeys.append(cls._rowkey())
+        if layout != cls.SINGLE:
+            rowkeys.append(cls._shard_rowkey_for_pixel(x, y))
+        return rowkeys
+
+    @classmethod
+    def _columns(cls, pixel):
+        if _use_compact_columns():
+            user_id = _user_id(pixel.user_fullname)
+            return {
+                (pixel.x, pixel.y): CANVAS_COLUMN.pack(
+                    PIXEL_COLUMN_VERSION,
+                    pixel.color,
+                    convert_uuid_to_time(pixel._id),
+                    user_id,
+                )
+            }
+
+        return {
             (pixel.x, pixel.y): json.dumps({
                 "color": pixel.color,
                 "timestamp": convert_uuid_to_time(pixel._id),
@@ -173,28 +1068,255 @@ class Canvas(tdb_cassandra.View):
                 "user_fullname": pixel.user_fullname,
             })
         }
-        cls._cf.insert(cls._rowkey(), columns)
+
+    @classmethod
+    def queue_pixel(cls, mutator, pixel):
+        columns = cls._columns(pixel)
+        for rowkey in cls._write_rowkeys(pixel.x, pixel.y):
+            mutator.insert(
+                cls._cf, rowkey, columns, timestamp=_write_timestamp(pixel))
 
     @classmethod
     def get(cls, x, y):
         column = (x, y)
+        layout = cls._layout()
+
+        rowkeys = []
+        if layout != cls.SINGLE:
+            rowkeys.append(cls._shard_rowkey_for_pixel(x, y))
+        if layout != cls.SHARDED:
+            rowkeys.append(cls._rowkey())
+
+        for rowkey in rowkeys:
+            try:
+                row = cls._cf.get(rowkey, columns=[column])
+            except tdb_cassandra.NotFoundException:
+                continue
+
+            if column in row:
+                pixel_dict = unpack_canvas_column(row[column])
+                resolve_user_names([pixel_dict])
+                return pixel_dict
+        return {}
+
+    @classmethod
+    def get_region(cls, x0, y0, x1, y1):
+        """Return dict of (x,y) -> pixel for the inclusive rectangle.
+
+        Only the columns in the region are asked for by name, from each row
+        that holds any of them.  A slice would be cheaper to describe but
+        reads every y for each x in the region.
+
+        """
+
+        columns = [
+            (x, y)
+            for x in xrange(x0, x1 + 1)
+            for y in xrange(y0, y1 + 1)
+        ]
+
+        layout = cls._layout()
+        columns_by_rowkey = []
+        if layout != cls.SHARDED:
+            columns_by_rowkey.append((cls._rowkey(), columns))
+        if layout != cls.SINGLE:
+            # shards are read last so they win over the original row.
+            shard_columns = {}
+            for x, y in columns:
+                shard_columns.setdefault(
+                    cls._shard_rowkey_for_pixel(x, y), []).append((x, y))
+            columns_by_rowkey.extend(sorted(shard_columns.iteritems()))
+
+        pixels = {}
+        for rowkey, row_columns in columns_by_rowkey:
+            try:
+                row = cls._cf.get(rowkey, columns=row_columns)
+            except tdb_cassandra.NotFoundException:
+                continue
+            pixels.update(
+                (column, unpack_canvas_column(d))
+                for column, d in row.iteritems()
+            )
+
+        resolve_user_names(pixels.values())
+        return pixels
+
+    @classmethod
+    def iter_row(cls, rowkey):
+        """Yield ((x, y), pixel_dict) for each column in a row as it's read.
+
+        Usernames of pixels in the compact format aren't looked up, they're
+        left as None.
+
+        """
         try:
-            row = cls._cf.get(cls._rowkey(), columns=[column])
+            for column, d in cls._cf.xget(rowkey, buffer_size=ROW_BUFFER_SIZE):
+                yield column, unpack_canvas_column(d)
         except tdb_cassandra.NotFoundException:
-            return {}
+            return
 
-        d = row.get(column, '{}')
-        pixel_dict = json.loads(d)
-        return pixel_dict
+    @classmethod
+    def read_passes(cls):
+        """Return the rows that make up the board, grouped into passes.
+
+        The rows within a pass don't overlap so can be read in any order (or
+        in parallel), but each pass must be applied after the one before it.
+
+        """
+
+        layout = cls._layout()
+        passes = []
+        if layout != cls.SHARDED:
+            passes.append([cls._rowkey()])
+        if layout != cls.SINGLE:
+            passes.append(cls._shard_rowkeys())
+        return passes
 
     @classmethod
-    def get_all(cls):
+    def get_all(cls, threads=CANVAS_TILES_X):
         """Return dict of (x,y) -> color"""
+        def get_row(rowkey):
+            return dict(cls.iter_row(rowkey))
+
+        canvas = {}
+        pool = ThreadPool(threads)
+        try:
+            for rowkeys in cls.read_passes():
+                for row in pool.imap_unordered(get_row, rowkeys):
+                    canvas.update(row)
+        finally:
+            pool.close()
+
+        return canvas
+
+
+class BoardChanges(tdb_cassandra.View):
+    """
+    Every placement ever made, in order, for rebuilding past boards.
+
+    Placements are bucketed into one row per HISTORY_INTERVAL, keyed on the
+    start of the interval, with the pixel's TimeUUID as the column so a slice
+    of a row comes back in the order the pixels were placed.  Values are
+    packed the same way as the redis change log.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+    _compare_with = TIME_UUID_TYPE
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    @classmethod
+    def bucket(cls, timestamp):
+        return int(timestamp) / HISTORY_INTERVAL * HISTORY_INTERVAL
+
+    @classmethod
+    def _rowkey(cls, bucket):
+        return "%s_%d" % (CANVAS_ID, bucket)
+
+    @classmethod
+    def queue_pixel(cls, mutator, pixel):
+        timestamp = convert_uuid_to_time(pixel._id)
+        columns = {pixel._id: RedisChangeLog.pack(pixel.color, pixel.x, pixel.y)}
+        mutator.insert(
+            cls._cf,
+            cls._rowkey(cls.bucket(timestamp)),
+            columns,
+            timestamp=_write_timestamp(pixel),
+        )
+
+    @classmethod
+    def iter_changes(cls, start, end):
+        """Yield the packed changes placed from `start` up to `end`."""
+        column_start = convert_time_to_uuid(start, lowest_val=True)
+        column_finish = convert_time_to_uuid(end, lowest_val=True)
+
+        bucket = cls.bucket(start)
+        while bucket < end:
+            try:
+                columns = cls._cf.xget(
+                    cls._rowkey(bucket),
+                    column_start=column_start,
+                    column_finish=column_finish,
+                    buffer_size=ROW_BUFFER_SIZE,
+                )
+                for _, packed in columns:
+                    yield packed
+            except tdb_cassandra.NotFoundException:
+                pass
+            bucket += HISTORY_INTERVAL
+
+
+class BoardKeyframe(tdb_cassandra.View):
+    """
+    Bitmaps of the board as it was at a point in time.
+
+    Each keyframe is stored zlib compressed in its own row.  When they were
+    taken is recorded in BoardKeyframesByTime.
+
+    """
+
+    _use_db = True
+    _connection_pool = 'main'
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    COLUMN = "bitmap"
+
+    @classmethod
+    def _rowkey(cls, timestamp):
+        return "%s_%d" % (CANVAS_ID, timestamp)
+
+    @classmethod
+    def add(cls, timestamp, bitmap):
+        cls._cf.insert(
+            cls._rowkey(timestamp), {cls.COLUMN: zlib.compress(bitmap)})
+        BoardKeyframesByTime.add(timestamp)
+
+    @classmethod
+    def get(cls, timestamp):
         try:
-            gen = cls._cf.xget(cls._rowkey())
+            row = cls._cf.get(cls._rowkey(timestamp), columns=[cls.COLUMN])
         except tdb_cassandra.NotFoundException:
-            return {}
+            return None
+        return zlib.decompress(row[cls.COLUMN])
 
-        return {
-            (x, y): json.loads(d) for (x, y), d in gen
-        }
+
+class BoardKeyframesByTime(tdb_cassandra.View):
+    _use_db = True
+    _connection_pool = 'main'
+    _compare_with = IntegerType()
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+
+    @classmethod
+    def _rowkey(cls):
+        return CANVAS_ID
+
+    @classmethod
+    def add(cls, timestamp):
+        cls._cf.insert(cls._rowkey(), {int(timestamp): ''})
+
+    @classmethod
+    def get_latest(cls, before=None):
+        """Return the time of the latest keyframe at or before `before`."""
+        kwargs = {}
+        if before is not None:
+            kwargs["column_start"] = int(before)
+
+        try:
+            columns = cls._cf.get(
+                cls._rowkey(), column_count=1, column_reversed=True, **kwargs)
+        except tdb_cassandra.NotFoundException:
+            return None
+        return columns.keys()[0]
+
+    @classmethod
+    def get_earliest(cls):
+        """Return the time of the first keyframe."""
+        try:
+            columns = cls._cf.get(cls._rowkey(), column_count=1)
+        except tdb_cassandra.NotFoundException:
+            return None
+        return columns.keys()[0]
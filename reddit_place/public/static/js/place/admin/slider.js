@@ -3,7 +3,10 @@
   var r = require('r');
 
   var bindEvents = require('utils').bindEvents;
+  var Canvasse = require('canvasse');
   var Client = require('client');
+  var R2Server = require('api');
+  var World = require('world');
 
   var ZOOM_LEVELS = [
     .25,
@@ -13,6 +16,100 @@
     Client.ZOOM_MAX_SCALE,
   ];
 
+  // Seconds between stops on the history slider.  Historical boards are
+  // cached for a long time, so landing on the same stops means scrubbing back
+  // and forth mostly hits the cache.
+  var HISTORY_STEP = 10;
+
+  /**
+   * Draw a board state without touching the client's own copy of it.
+   * @function
+   * @param {Uint8Array} state A Uint8Array of color indices
+   */
+  function drawState(state) {
+    for (var i = 0; i < state.length; i++) {
+      Canvasse.setBufferState(i, Client.getPaletteColorABGR(state[i]));
+    }
+    Canvasse.drawBufferToDisplay();
+  }
+
+  /**
+   * Add a slider for scrubbing through the history of the board.
+   * @function
+   * @param {HTMLElement} palette
+   */
+  function addHistorySlider(palette) {
+    var start = r.config.place_history_start;
+    if (!start) { return; }
+
+    var now = Math.floor(Date.now() / 1000);
+    var slider = $.parseHTML('<input type="range">')[0];
+    $(slider)
+      .attr('min', start)
+      .attr('max', now)
+      .attr('step', HISTORY_STEP)
+      .attr('value', now)
+      .css('width', '200px');
+    palette.appendChild(slider);
+
+    // Only one board is fetched at a time, if the slider moved while it was
+    // loading we fetch wherever it ended up once it's done.
+    var loading = false;
+    var pending = null;
+
+    // The last stop on the slider may fall short of max, anything within a
+    // step of it counts as the present.
+    function isLive(at) {
+      return at + HISTORY_STEP > slider.max;
+    }
+
+    function showBoard(at) {
+      if (isLive(at)) {
+        // Live placements kept going into the client's own copy of the
+        // board the whole time, so going back to it needs no fetch.
+        pending = null;
+        World.enable();
+        return;
+      }
+
+      // Stop live placements being drawn over the past.
+      World.disable();
+      if (loading) {
+        pending = at;
+        return;
+      }
+      loading = true;
+
+      R2Server.getCanvasBitmapState(at)
+        .always(function() {
+          loading = false;
+        })
+        .then(function(timestamp, canvas) {
+          if (pending !== null) {
+            var next = pending;
+            pending = null;
+            showBoard(next);
+            return;
+          }
+
+          // Back to the present while this was loading.
+          if (World.enabled || !canvas) { return; }
+          drawState(canvas);
+        });
+    }
+
+    bindEvents(slider, {
+      'input': function(e) {
+        showBoard(parseInt(slider.value, 10));
+      },
+
+      'mousedown': function(e) {
+        // Stretch the slider up to the present.
+        $(slider).attr('max', Math.floor(Date.now() / 1000));
+      },
+    });
+  }
+
   r.hooks.get('place.init').register(function() {
     var palette = document.getElementById('place-palette');
     var slider = $.parseHTML('<input type="range" min="0" step="1">')[0];
@@ -37,5 +134,7 @@
         Client.enablePan();
       },
     });
+
+    addHistorySlider(palette);
   });
 });
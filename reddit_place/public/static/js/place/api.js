@@ -16,6 +16,9 @@
 
   var injectedHeaders = {};
 
+  // Bytes before the bitmap in a board-bitmap response, see BOARD_HEADER.
+  var BOARD_HEADER_SIZE = 8;
+
   // Collection of functions that call out to the backend API.
   // All requests made to the banckend from the client are defined here.
   return {
@@ -46,16 +49,79 @@
 
     /**
      * GET a bitmap representation of the board state
+     * Resolves with the timestamp the board was read at, the board, and its
+     * generation, which broadcast placements can be compared against.
      * @function
+     * @param {number} [at] Timestamp to get the board as of, defaults to now.
+     *    Only admins can see past boards.
      * @returns {Promise}
      */
-    getCanvasBitmapState: function() {
+    getCanvasBitmapState: function(at) {
       var dfd = $.Deferred();
 
       var timestamp;
+      var generation;
       var canvas = new Uint8Array(r.config.place_canvas_width * r.config.place_canvas_height);
       var offset = 0;
 
+      // The server may be configured to send a compressed format.  Deflate is
+      // undone by the browser, run-length encoded (PackBits) data we decode
+      // ourselves as it streams in.
+      var format = r.config.place_board_format;
+      var params = [];
+      if (format) {
+        params.push("format=" + format);
+      }
+      // Past boards come from an admin-only endpoint.
+      var url = "/api/place/board-bitmap";
+      if (at) {
+        params.push("at=" + at);
+        url = "/api/place/board-history";
+      }
+      if (params.length) {
+        url += "?" + params.join("&");
+      }
+
+      // PackBits decoder state, which carries over between chunks.
+      var literalRemaining = 0;
+      var repeatCount = 0;
+
+      /**
+       * Write a byte of the bitmap, which holds two values in the canvas.
+       * @function
+       * @param {int} value
+       */
+      function writeByte(value) {
+        canvas[offset] = value >> 4;
+        canvas[offset + 1] = value & 15;
+        offset += 2;
+      }
+
+      /**
+       * Decode a chunk of PackBits-encoded bitmap.
+       * @function
+       * @param {Uint8Array} responseArray
+       */
+      function handleRLEChunk(responseArray) {
+        var value;
+        for (var i = 0; i < responseArray.byteLength; i++) {
+          value = responseArray[i];
+          if (literalRemaining) {
+            writeByte(value);
+            literalRemaining--;
+          } else if (repeatCount) {
+            for (var j = 0; j < repeatCount; j++) {
+              writeByte(value);
+            }
+            repeatCount = 0;
+          } else if (value < 128) {
+            literalRemaining = value + 1;
+          } else if (value > 128) {
+            repeatCount = 257 - value;
+          }
+        }
+      }
+
       /**
        * Handle a single "chunk" or response data.
        * This modifies the local timestamp, canvas, and offset variables.
@@ -63,24 +129,28 @@
        * @param {Uint8Array} responseArray
        */
       function handleChunk(responseArray) {
-        // If we haven't set the timestamp yet, slice it off of this chunk
+        // If we haven't set the timestamp yet, slice the header off of this
+        // chunk.  It's the timestamp followed by the board's generation.
         if (!timestamp) {
           timestamp = (new Uint32Array(responseArray.buffer, 0, 1))[0],
-          responseArray = new Uint8Array(responseArray.buffer, 4);
+          generation = (new Uint32Array(responseArray.buffer, 4, 1))[0],
+          responseArray = new Uint8Array(responseArray.buffer, BOARD_HEADER_SIZE);
+        }
+        if (format === 'rle') {
+          handleRLEChunk(responseArray);
+          return;
         }
         // Each byte in the responseArray represents two values in the canvas
         for (var i = 0; i < responseArray.byteLength; i++) {
-          canvas[offset + 2 * i] = responseArray[i] >> 4;
-          canvas[offset + 2 * i + 1] = responseArray[i] & 15;
+          writeByte(responseArray[i]);
         }
-        offset += responseArray.byteLength * 2;
       }
 
       if (window.fetch) {
         // If the fetch API is available, use it so we can process the response
         // in chunks as it comes in.
         // TODO - should we render the board as it streams in?
-        fetch(buildFullURL("/api/place/board-bitmap"), { credentials: 'include' })
+        fetch(buildFullURL(url), { credentials: 'include' })
           .then(function(res) {
             // Firefox implements the fetch API, but doesn't support the
             // ReadableStream portion that Chrome does. In that case we'll
@@ -89,7 +159,7 @@
             if (!(res.body && res.body.getReader)) {
               res.arrayBuffer().then(function(arrayBuffer) {
                 handleChunk(new Uint8Array(arrayBuffer));
-                dfd.resolve(timestamp, canvas);
+                dfd.resolve(timestamp, canvas, generation);
               });
               return;
             }
@@ -97,7 +167,7 @@
             function next(reader) {
               reader.read().then(function(chunk) {
                 if (chunk.done) {
-                  dfd.resolve(timestamp, canvas);
+                  dfd.resolve(timestamp, canvas, generation);
                 } else {
                   handleChunk(chunk.value);
                   next(reader);
@@ -110,14 +180,14 @@
         // Fall back to using a normal XHR request.
         var oReq = new XMLHttpRequest();
         oReq.responseType = "arraybuffer";
-        var resp = oReq.open("GET", buildFullURL("/api/place/board-bitmap"), true);
+        var resp = oReq.open("GET", buildFullURL(url), true);
 
         oReq.onload = function (oEvent) {
           var arrayBuffer = oReq.response;
           if (!arrayBuffer) { dfd.resolve(); }
           var responseArray = new Uint8Array(arrayBuffer);
           handleChunk(responseArray);
-          dfd.resolve(timestamp, canvas);
+          dfd.resolve(timestamp, canvas, generation);
         };
 
         oReq.send(null);
@@ -126,6 +196,41 @@
       return dfd.promise();
     },
 
+    /**
+     * GET the pixels placed since the given board timestamp.
+     * Resolves with the timestamp to use for the next request and a
+     * Uint32Array of `offset << 4 | color` records.  Rejects if the server
+     * can't go back that far, in which case the full bitmap is needed.
+     * @function
+     * @param {number} since Timestamp of the last board state we have
+     * @returns {Promise}
+     */
+    getCanvasDelta: function(since) {
+      var dfd = $.Deferred();
+
+      var oReq = new XMLHttpRequest();
+      oReq.responseType = "arraybuffer";
+      oReq.open("GET", buildFullURL("/api/place/board-delta?since=" + since), true);
+
+      oReq.onload = function (oEvent) {
+        var arrayBuffer = oReq.response;
+        if (oReq.status !== 200 || !arrayBuffer) {
+          dfd.reject();
+          return;
+        }
+        var timestamp = (new Uint32Array(arrayBuffer, 0, 1))[0];
+        var changes = new Uint32Array(arrayBuffer, 4);
+        dfd.resolve(timestamp, changes);
+      };
+      oReq.onerror = function() {
+        dfd.reject();
+      };
+
+      oReq.send(null);
+
+      return dfd.promise();
+    },
+
     /**
      * GET the amount of time remaining on the current user's cooldown.
      * @function
@@ -159,5 +264,28 @@
         },
       });
     },
+
+    /**
+     * Get info about every pixel in a rectangle.
+     * @function
+     * @param {int} x0,
+     * @param {int} y0,
+     * @param {int} x1, inclusive
+     * @param {int} y1, inclusive
+     * @returns {Promise}
+     */
+    getPixelsInfo: function(x0, y0, x1, y1) {
+      return r.ajax({
+        url: buildOauthUrl('/api/place/pixels.json'),
+        headers: injectedHeaders,
+        type: 'GET',
+        data: {
+          x0: x0,
+          y0: y0,
+          x1: x1,
+          y1: y1,
+        },
+      });
+    },
   };
 });
@@ -54,6 +54,11 @@
 
   var autoCameraIntervalToken;
 
+  // The inspector fetches info for the pixels within this many tiles of the
+  // one inspected, and reuses it for this long.
+  var PIXEL_INFO_PREFETCH_RADIUS = 5;
+  var PIXEL_INFO_TTL = 10000;
+
   var B = 0;
   var k = 1;
   var f = .5;
@@ -145,6 +150,10 @@
     _panY: 0,
     _zoom: 1,
     _currentDirection: { x: 0, y: 0 },
+    // Prefetched pixel info, keyed on "x,y", for the region it covers.
+    _pixelInfo: {},
+    _pixelInfoRegion: null,
+    _pixelInfoExpires: 0,
 
     /**
      * Initialize
@@ -722,16 +731,15 @@
     inspectTile: function(x, y) {
       this.interact();
 
-      R2Server.getPixelInfo(x, y).then(
-        // TODO - actually do something with this info in the UI.
-        function onSuccess(responseJSON, status, jqXHR) {
-          if ('color' in responseJSON) {
+      this.getPixelInfo(x, y).then(
+        function onSuccess(pixelInfo) {
+          if (pixelInfo) {
             this.setTargetCameraLocation(x, y);
             Inspector.show(
-              responseJSON.x,
-              responseJSON.y,
-              responseJSON.user_name,
-              responseJSON.timestamp
+              pixelInfo.x,
+              pixelInfo.y,
+              pixelInfo.user_name,
+              pixelInfo.timestamp
             );
           } else if (Inspector.isVisible) {
             Inspector.hide();
@@ -744,6 +752,47 @@
       )
     },
 
+    /**
+     * Get info about the tile at the given coordinates.
+     * Info for the tiles around it is fetched in the same request, so
+     * inspecting nearby tiles afterwards doesn't need to hit the server.
+     * @function
+     * @param {number} x
+     * @param {number} y
+     * @returns {Promise} Resolves with the pixel info, or undefined if
+     *    nobody has placed a tile there.
+     */
+    getPixelInfo: function(x, y) {
+      var region = this._pixelInfoRegion;
+      if (region && Date.now() < this._pixelInfoExpires &&
+          region.x0 <= x && x <= region.x1 &&
+          region.y0 <= y && y <= region.y1) {
+        return $.Deferred().resolve(this._pixelInfo[x + ',' + y]).promise();
+      }
+
+      var radius = PIXEL_INFO_PREFETCH_RADIUS;
+      region = {
+        x0: Math.max(0, x - radius),
+        y0: Math.max(0, y - radius),
+        x1: Math.min(Canvasse.width - 1, x + radius),
+        y1: Math.min(Canvasse.height - 1, y + radius),
+      };
+
+      return R2Server.getPixelsInfo(region.x0, region.y0, region.x1, region.y1)
+        .then(function onSuccess(responseJSON, status, jqXHR) {
+          var pixelInfo = {};
+          var pixels = responseJSON.pixels || [];
+          for (var i = 0; i < pixels.length; i++) {
+            pixelInfo[pixels[i].x + ',' + pixels[i].y] = pixels[i];
+          }
+
+          this._pixelInfo = pixelInfo;
+          this._pixelInfoRegion = region;
+          this._pixelInfoExpires = Date.now() + PIXEL_INFO_TTL;
+          return pixelInfo[x + ',' + y];
+        }.bind(this));
+    },
+
     /**
      * Toggles between the two predefined zoom levels.
      * @function
@@ -945,6 +994,14 @@
      */
     receiveTile: function(x, y) {
       this.trackRecentTile(x, y);
+
+      // Prefetched pixel info is out of date once a tile in it changes.
+      var region = this._pixelInfoRegion;
+      if (region && region.x0 <= x && x <= region.x1 &&
+          region.y0 <= y && y <= region.y1) {
+        this._pixelInfoExpires = 0;
+      }
+
       if (!this.isWorldAudioEnabled) { return; }
       var camCoords = this.getCameraLocationFromOffset(this._panX, this._panY);
       var dist = Math.abs(getDistance(camCoords.x, camCoords.y, x, y));
@@ -26,6 +26,7 @@
   var R2Server = require('api');
   var Timer = require('timer');
   var WebsocketEvents = require('websocketevents');
+  var World = require('world');
   var ZoomButton = require('zoombutton');
   var ZoomButtonEvents = require('zoombuttonevents');
   var NotificationButton = require('notificationbutton');
@@ -257,13 +258,41 @@
       Canvasse.drawTileToDisplay(minLoadingX + loadingX, loadingY, 'black');
     });
 
-    R2Server.getCanvasBitmapState().then(function(timestamp, canvas) {
+    // Timestamp of the most recent board state we've applied, used to catch
+    // up with the board-delta API after the websocket drops.
+    var boardTimestamp = null;
+    // Generation of the board we've applied.  Until there is one, placements
+    // from the websocket are buffered, then replayed on top of the board
+    // skipping any that it already has.
+    var boardGeneration = null;
+    var pendingBroadcasts = [];
+
+    function receiveBroadcast(type, message) {
+      if (boardGeneration === null) {
+        pendingBroadcasts.push([type, message]);
+        return;
+      }
+      WebsocketEvents['message:' + type](message);
+    }
+
+    function setBoard(timestamp, canvas, generation) {
+      boardTimestamp = timestamp;
+      boardGeneration = generation || 0;
+      Client.setInitialState(canvas);
+
+      pendingBroadcasts.forEach(function(broadcast) {
+        WebsocketEvents['message:' + broadcast[0]](broadcast[1], boardGeneration);
+      });
+      pendingBroadcasts = [];
+    }
+
+    R2Server.getCanvasBitmapState().then(function(timestamp, canvas, generation) {
       // TODO - request non-cached version if the timestamp is too old
       if (!canvas) { return; }
       
       loadingAnimationCancel();
       Canvasse.clearRectFromDisplay(minLoadingX, loadingY, loadingWidth, 1);
-      Client.setInitialState(canvas);
+      setBoard(timestamp, canvas, generation);
       if (usingBlurryCanvasFix) {
         redrawDisplayCanvas();
       }
@@ -273,8 +302,48 @@
 
     });
 
+    function resyncBoard() {
+      R2Server.getCanvasDelta(boardTimestamp).then(
+        function onSuccess(timestamp, changes) {
+          boardTimestamp = timestamp;
+          World.applyDelta(changes);
+        },
+
+        function onError() {
+          // The server doesn't have enough history, start over.
+          boardGeneration = null;
+          R2Server.getCanvasBitmapState().then(function(timestamp, canvas, generation) {
+            if (!canvas) { return; }
+            setBoard(timestamp, canvas, generation);
+          });
+        }
+      );
+    }
+
     var websocket = new r.WebSocket(websocketUrl);
-    websocket.on(WebsocketEvents);
+    var wasDisconnected = false;
+    websocket.on($.extend({}, WebsocketEvents, {
+      'message:place': function(message) {
+        receiveBroadcast('place', message);
+      },
+
+      'message:batch-place': function(messages) {
+        receiveBroadcast('batch-place', messages);
+      },
+    }));
+    websocket.on({
+      'disconnected': function() {
+        wasDisconnected = true;
+      },
+
+      'connected': function() {
+        // Anything placed while we were disconnected was missed.
+        if (wasDisconnected && boardTimestamp !== null) {
+          resyncBoard();
+        }
+        wasDisconnected = false;
+      },
+    });
     websocket.start();
 
     // TODO - fix this weird naming?
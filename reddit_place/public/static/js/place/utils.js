@@ -117,5 +117,19 @@
       vector.x = x / length;
       vector.y = y / length;
     },
+
+    /**
+     * Decode a base64 string into a new ArrayBuffer.
+     * @param {string} encoded
+     * @returns {ArrayBuffer}
+     */
+    decodeBase64: function(encoded) {
+      var decoded = atob(encoded);
+      var bytes = new Uint8Array(decoded.length);
+      for (var i = 0; i < decoded.length; i++) {
+        bytes[i] = decoded.charCodeAt(i);
+      }
+      return bytes.buffer;
+    },
   };
 });
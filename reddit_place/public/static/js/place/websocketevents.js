@@ -1,8 +1,13 @@
 !r.placeModule('websocketevents', function(require) {
+  var decodeBase64 = require('utils').decodeBase64;
   var World = require('world');
 
   // Events pushed from the server over websockets, primarily representing
   // actions taken by other users.
+  //
+  // Placements carry the board generation they were made in as their seq.
+  // When replaying placements that arrived before the board did, `afterSeq`
+  // is the board's generation and anything already in it is skipped.
   return {
     'connecting': function() {
       console.log('connecting');
@@ -20,15 +25,41 @@
       console.log('reconnecting in ' + delay + ' seconds...');
     },
 
-    'message:place': function(message) {
+    'message:place': function(message, afterSeq) {
+      if (afterSeq && message.seq <= afterSeq) { return; }
       World.drawTile(message.x, message.y, message.color);
     },
 
-    'message:batch-place': function(messages) {
+    'message:batch-place': function(messages, afterSeq) {
       if (Array.isArray(messages)) {
         messages.forEach(function(message) {
+          if (afterSeq && message.seq <= afterSeq) { return; }
           World.drawTile(message.x, message.y, message.color);
         });
+      } else if (messages && messages.format === 'binary') {
+        // Base64 of packed `offset << 4 | color` uint32s, and of the uint32
+        // seq of each.  The matching `author_ids` index into `authors` but
+        // aren't needed for drawing.
+        var pixels = new Uint32Array(decodeBase64(messages.pixels));
+        if (afterSeq && messages.seqs) {
+          var seqs = new Uint32Array(decodeBase64(messages.seqs));
+          var newer = [];
+          for (var i = 0; i < pixels.length; i++) {
+            if (seqs[i] > afterSeq) {
+              newer.push(pixels[i]);
+            }
+          }
+          pixels = new Uint32Array(newer);
+        }
+        World.drawPackedTiles(pixels);
+      } else if (messages && Array.isArray(messages.x)) {
+        // Packed as parallel arrays of author, x, y, color, and seq.
+        for (var i = 0; i < messages.x.length; i++) {
+          if (afterSeq && messages.seq && messages.seq[i] <= afterSeq) {
+            continue;
+          }
+          World.drawTile(messages.x[i], messages.y[i], messages.color[i]);
+        }
       }
     },
 
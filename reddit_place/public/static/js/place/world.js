@@ -3,24 +3,54 @@
   var Canvasse = require('canvasse');
   var Client = require('client');
 
-  // Handles actions remote users take
+  // Handles actions remote users take.  While disabled, e.g. while an admin
+  // is looking back through the board's history, only the client's copy of
+  // the board is kept up to date and it's redrawn from that once re-enabled.
   return {
     enabled: true,
 
-    drawTile: function(x, y, color) {
-      var color = Client.getPaletteColorABGR(color);
+    drawTile: function(x, y, colorIndex) {
       var i = Canvasse.getIndexFromCoords(x, y);
-      Client.state[i] = this.colorIndex;
+      Client.state[i] = colorIndex;
 
       if (this.enabled) {
-        Canvasse.drawTileAt(x, y, color);
-      } else {
-        Canvasse.drawTileToBuffer(x, y, color);
+        Canvasse.drawTileToBuffer(x, y, Client.getPaletteColorABGR(colorIndex));
       }
 
       Client.receiveTile(x, y);
     },
 
+    /**
+     * Draw a batch of packed tiles in a single pass.
+     * The buffer is redrawn to the display once, on the next tick.
+     * @function
+     * @param {Uint32Array} tiles `offset << 4 | color` records, as sent by
+     *    binary batch-place messages and the board-delta API.
+     */
+    drawPackedTiles: function(tiles) {
+      if (!tiles.length) { return; }
+
+      var offset, colorIndex;
+      for (var i = 0; i < tiles.length; i++) {
+        offset = tiles[i] >>> 4;
+        colorIndex = tiles[i] & 15;
+        Client.state[offset] = colorIndex;
+        if (this.enabled) {
+          Canvasse.setBufferState(offset, Client.getPaletteColorABGR(colorIndex));
+        }
+        Client.receiveTile(offset % Canvasse.width, (offset / Canvasse.width) | 0);
+      }
+    },
+
+    /**
+     * Apply packed changes from the board-delta API.
+     * @function
+     * @param {Uint32Array} changes `offset << 4 | color` records
+     */
+    applyDelta: function(changes) {
+      this.drawPackedTiles(changes);
+    },
+
     updateActivity: function(count) {
       Activity.setCount(count);
     },
@@ -35,11 +65,17 @@
     },
 
     /**
-     * Re-enable the client.
+     * Re-enable the client, catching the display up on anything placed while
+     * it was disabled.
      * @function
      */
     enable: function() {
+      if (this.enabled) { return; }
       this.enabled = true;
+
+      for (var i = 0; i < Client.state.length; i++) {
+        Canvasse.setBufferState(i, Client.getPaletteColorABGR(Client.state[i]));
+      }
     },
   };
 });
@@ -0,0 +1,103 @@
+import struct
+import zlib
+
+from reddit_place.models import (
+    BOARD_HEADER,
+    CANVAS_BITMAP_SIZE,
+    CANVAS_HEIGHT,
+    CANVAS_WIDTH,
+)
+
+
+# Server-side copy of Client.DEFAULT_COLOR_PALETTE in client.js.
+DEFAULT_COLOR_PALETTE = (
+    (0xFF, 0xFF, 0xFF),  # white
+    (0xE4, 0xE4, 0xE4),  # light grey
+    (0x88, 0x88, 0x88),  # grey
+    (0x22, 0x22, 0x22),  # black
+    (0xFF, 0xA7, 0xD1),  # pink
+    (0xE5, 0x00, 0x00),  # red
+    (0xE5, 0x95, 0x00),  # orange
+    (0xA0, 0x6A, 0x42),  # brown
+    (0xE5, 0xD9, 0x00),  # yellow
+    (0x94, 0xE0, 0x44),  # lime
+    (0x02, 0xBE, 0x01),  # green
+    (0x00, 0xD3, 0xDD),  # cyan
+    (0x00, 0x83, 0xC7),  # blue
+    (0x00, 0x00, 0xEA),  # dark blue
+    (0xCF, 0x6E, 0xE4),  # magenta
+    (0x82, 0x00, 0x80),  # purple
+)
+MAX_PNG_SCALE = 4
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPE_INDEXED = 3
+PNG_FILTER_NONE = "\x00"
+
+# Translation tables picking the high and low nibble out of each byte.
+_HIGH_NIBBLES = ''.join(chr(i >> 4) for i in xrange(256))
+_LOW_NIBBLES = ''.join(chr(i & 15) for i in xrange(256))
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + chunk_type + data + \
+        struct.pack(">I", crc)
+
+
+def _unpack_nibbles(bitmap):
+    """Return a bytearray with one color index per pixel."""
+    pixels = bytearray(len(bitmap) * 2)
+    pixels[0::2] = bitmap.translate(_HIGH_NIBBLES)
+    pixels[1::2] = bitmap.translate(_LOW_NIBBLES)
+    return pixels
+
+
+def render_png(bitmap, scale=1):
+    """Render a raw 4-bit packed bitmap as an indexed-color PNG.
+
+    The palette goes in the PLTE chunk, so there's no per-pixel color lookup
+    at all.  At scale 1 the bitmap is already valid 4-bit PNG image data, and
+    for larger scales pixels and rows are repeated with slice assignments
+    rather than Python loops over every pixel.
+
+    """
+
+    bitmap = bitmap.ljust(CANVAS_BITMAP_SIZE, "\x00")
+    width = CANVAS_WIDTH * scale
+    height = CANVAS_HEIGHT * scale
+
+    if scale == 1:
+        bit_depth = 4
+        row_size = CANVAS_WIDTH / 2
+        scaled = bitmap
+    else:
+        bit_depth = 8
+        row_size = width
+        pixels = _unpack_nibbles(bitmap)
+        scaled = bytearray(len(pixels) * scale)
+        for i in xrange(scale):
+            scaled[i::scale] = pixels
+        scaled = str(scaled)
+
+    rows = []
+    for y in xrange(CANVAS_HEIGHT):
+        row = PNG_FILTER_NONE + scaled[y * row_size:(y + 1) * row_size]
+        rows.extend([row] * scale)
+
+    header = struct.pack(
+        ">IIBBBBB", width, height, bit_depth, PNG_COLOR_TYPE_INDEXED, 0, 0, 0)
+    palette = ''.join(struct.pack("BBB", *rgb) for rgb in DEFAULT_COLOR_PALETTE)
+
+    return ''.join([
+        PNG_SIGNATURE,
+        _png_chunk("IHDR", header),
+        _png_chunk("PLTE", palette),
+        _png_chunk("IDAT", zlib.compress(''.join(rows), 6)),
+        _png_chunk("IEND", ""),
+    ])
+
+
+def render_board_png(board, scale=1):
+    """Render a board-bitmap response body, header and all, as a PNG."""
+    return render_png(board[BOARD_HEADER.size:], scale)
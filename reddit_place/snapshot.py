@@ -0,0 +1,180 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import baseplate_integration
+
+from reddit_place.models import (
+    BOARD_HEADER,
+    CANVAS_HEIGHT,
+    CANVAS_WIDTH,
+    RedisCanvas,
+)
+
+
+# A snapshot file is this header followed by a board-bitmap response body
+# (BOARD_HEADER and then the 4-bit packed bitmap), so the body can be served
+# straight out of the mapped file.
+SNAPSHOT_MAGIC = "PLCE"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sHHHd")
+SNAPSHOT_FILENAME = "board.snapshot"
+DEFAULT_SNAPSHOT_INTERVAL = 10
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _snapshot_dir():
+    return getattr(g, "place_snapshot_dir", None)
+
+
+def get_snapshot_path():
+    snapshot_dir = _snapshot_dir()
+    if not snapshot_dir:
+        return None
+    return os.path.join(snapshot_dir, SNAPSHOT_FILENAME)
+
+
+def write_snapshot(path, bitmap, timestamp, generation):
+    """Atomically replace the snapshot at `path`.
+
+    The new snapshot is written to a temporary file in the same directory and
+    renamed over the old one, so readers only ever see a complete snapshot.
+
+    """
+
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, CANVAS_WIDTH, CANVAS_HEIGHT,
+        timestamp)
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".%s." % SNAPSHOT_FILENAME)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            f.write(BOARD_HEADER.pack(int(timestamp), generation))
+            f.write(bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+class Snapshot(object):
+    """A snapshot file mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("truncated snapshot %s" % path)
+
+        magic, version, width, height, timestamp = SNAPSHOT_HEADER.unpack(
+            self._mm[:SNAPSHOT_HEADER.size])
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise SnapshotError("unknown snapshot format in %s" % path)
+        if (width, height) != (CANVAS_WIDTH, CANVAS_HEIGHT):
+            raise SnapshotError("snapshot %s is %dx%d" % (path, width, height))
+
+        self.timestamp = timestamp
+
+    @property
+    def board(self):
+        """The snapshot in the same format as RedisCanvas.get_board.
+
+        This is a buffer over the mapped file rather than a copy of it, so
+        looking at the header is free.  Take str() of it to serve it.
+
+        """
+
+        return buffer(self._mm, SNAPSHOT_HEADER.size)
+
+    @property
+    def bitmap(self):
+        """The raw 4-bit packed bitmap."""
+        return self._mm[SNAPSHOT_HEADER.size + BOARD_HEADER.size:]
+
+
+class SnapshotReader(object):
+    """Keeps the latest snapshot mapped, picking up new ones as they land.
+
+    The file is only stat-ed every `check_interval` seconds to see if the
+    snapshot job has replaced it.
+
+    """
+
+    def __init__(self, check_interval=1):
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the latest Snapshot, or None if there isn't one."""
+        if time.time() - self._checked < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if time.time() - self._checked >= self.check_interval:
+                self._checked = time.time()
+                self._refresh()
+        return self._snapshot
+
+    def _refresh(self):
+        path = get_snapshot_path()
+        if not path:
+            return
+
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            return
+
+        if self._snapshot and self._snapshot.inode == inode:
+            return
+
+        try:
+            self._snapshot = Snapshot(path)
+        except (EnvironmentError, SnapshotError) as e:
+            g.log.warning("place: couldn't load board snapshot: %s", e)
+
+
+latest_snapshot = SnapshotReader()
+
+
+@baseplate_integration.with_root_span("job.place_snapshot")
+def snapshot_board():
+    """Write the current board in redis out to the snapshot file."""
+    path = get_snapshot_path()
+    if not path:
+        raise SnapshotError("place_snapshot_dir isn't configured")
+
+    # Take the timestamp first, anything placed while we read the board will
+    # be replayed on top of the snapshot when restoring.
+    timestamp = time.time()
+    bitmap, generation = RedisCanvas.get_bitmap_and_generation()
+    write_snapshot(path, bitmap, timestamp, generation)
+
+
+def snapshot_board_periodically():
+    interval = getattr(
+        g, "place_snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL)
+
+    while True:
+        started = time.time()
+        try:
+            snapshot_board()
+        except Exception as e:
+            print "failed to write board snapshot: %s" % e
+        time.sleep(max(0, interval - (time.time() - started)))
@@ -0,0 +1,85 @@
+"""
+Timing of the individual stages of a request.
+
+Each stage is timed under place.stage.<name> in g.stats and gets a child
+span of the request's baseplate span.  Only `place_stage_sample_rate` of
+requests are instrumented, except admins' which always are and get a
+breakdown of the stages back in the DEBUG_HEADER response header.
+
+"""
+
+from contextlib import contextmanager
+import random
+import time
+
+from pylons import app_globals as g
+from pylons import tmpl_context as c
+
+
+DEBUG_HEADER = "X-Place-Stages"
+DEFAULT_SAMPLE_RATE = 0.01
+
+
+def _is_sampled():
+    # c hands back '' for anything that was never set.
+    sampled = getattr(c, "place_stage_sampled", None)
+    if not isinstance(sampled, bool):
+        if getattr(c, "user_is_admin", False):
+            sampled = True
+        else:
+            sample_rate = g.live_config.get(
+                "place_stage_sample_rate", DEFAULT_SAMPLE_RATE)
+            sampled = random.random() < sample_rate
+        c.place_stage_sampled = sampled
+        # only kept for the debug header.
+        c.place_stage_timings = [] if getattr(c, "user_is_admin", False) \
+            else None
+    return sampled
+
+
+def reset():
+    """Make a new sampling decision, for work done outside of a request.
+
+    In a request it's made once per request, but jobs and consumers share one
+    context for their whole life so should call this per unit of work.
+
+    """
+
+    c.place_stage_sampled = None
+
+
+@contextmanager
+def stage(name):
+    """Time the body of the with block as the stage `name`."""
+    if not _is_sampled():
+        yield
+        return
+
+    timer = g.stats.get_timer("place.stage." + name)
+    trace = getattr(c, "trace", None)
+    span = trace.make_child(name) if trace else None
+
+    timer.start()
+    if span:
+        span.start()
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        if span:
+            span.finish()
+        timer.stop()
+        if c.place_stage_timings is not None:
+            c.place_stage_timings.append((name, elapsed))
+
+
+def add_debug_header(response):
+    """Show admins how long each stage of their request took."""
+    if not getattr(c, "user_is_admin", False):
+        return
+
+    timings = getattr(c, "place_stage_timings", None)
+    if timings:
+        response.headers[DEBUG_HEADER] = ", ".join(
+            "%s=%.1fms" % (name, elapsed * 1000) for name, elapsed in timings)
@@ -0,0 +1,48 @@
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+from reddit_place import cache
+from reddit_place.cache import SnapshotCache
+
+
+class SnapshotCacheDerivedTest(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(cache, "g", MagicMock(stalecache=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = SnapshotCache("place:test", ttl=60, stat_name="test")
+        self.board = self.cache.get(lambda: "board")
+
+    def test_derived_once_per_version(self):
+        derive = MagicMock(return_value="derived")
+
+        for _ in xrange(3):
+            self.assertEqual(
+                self.cache.get_derived("rle", derive, self.board), "derived")
+
+        derive.assert_called_once_with("board")
+
+    def test_slow_derive_does_not_block_other_names(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow_derive(value):
+            started.set()
+            finish.wait(5)
+            return "png"
+
+        slow = threading.Thread(
+            target=self.cache.get_derived,
+            args=("png:4", slow_derive, self.board))
+        slow.start()
+        self.addCleanup(slow.join)
+        self.addCleanup(finish.set)
+        started.wait(5)
+
+        # returns while the png is still being rendered.
+        rle = self.cache.get_derived("rle", lambda value: "rle", self.board)
+        self.assertEqual(rle, "rle")
+        self.assertTrue(slow.is_alive())
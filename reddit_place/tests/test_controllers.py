@@ -0,0 +1,144 @@
+import unittest
+
+from mock import MagicMock, patch
+from redis.exceptions import RedisError
+from webob import Request, Response
+
+from reddit_place import board_formats, controllers, degraded
+from reddit_place.controllers import LoggedOutPlaceController
+from reddit_place.models import BOARD_HEADER, RedisCanvas
+
+
+class BoardBitmapRevalidationTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = LoggedOutPlaceController.__new__(
+            LoggedOutPlaceController)
+        self.board = BOARD_HEADER.pack(1491000000, 5) + "\0" * 16
+
+        self.board_cache = MagicMock()
+        self.board_cache.get.return_value = self.board
+        for target, name, value in (
+                (controllers, "g", MagicMock()),
+                (controllers, "BOARD_BITMAP_CACHE", self.board_cache),
+                (board_formats, "BOARD_BITMAP_CACHE", self.board_cache)):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch.object(
+            LoggedOutPlaceController, "_get_board_generation",
+            return_value=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_board_bitmap(self, url, if_none_match=None):
+        headers = {}
+        if if_none_match:
+            headers["If-None-Match"] = if_none_match
+        request = Request.blank(url, headers=headers)
+        response = Response()
+        with patch.object(controllers, "request", request), \
+                patch.object(controllers, "response", response):
+            body = self.controller.GET_board_bitmap()
+        return response, body
+
+    def test_current_etag_is_not_modified(self):
+        response, body = self.get_board_bitmap(
+            "/api/place/board-bitmap", if_none_match='"5"')
+
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(body, "")
+        self.assertEqual(response.headers["ETag"], '"5"')
+        self.assertFalse(self.board_cache.get.called)
+
+    def test_current_etag_of_format_is_not_modified(self):
+        response, body = self.get_board_bitmap(
+            "/api/place/board-bitmap?format=rle", if_none_match='"5-rle"')
+
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers["ETag"], '"5-rle"')
+
+    def test_old_etag_gets_board(self):
+        response, body = self.get_board_bitmap(
+            "/api/place/board-bitmap", if_none_match='"4"')
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(body, self.board)
+        self.assertEqual(response.headers["ETag"], '"5"')
+
+    def test_format_is_derived_from_board_of_etag(self):
+        self.board_cache.get_derived.return_value = "rle board"
+        response, body = self.get_board_bitmap(
+            "/api/place/board-bitmap?format=rle", if_none_match='"4-rle"')
+
+        self.assertEqual(body, "rle board")
+        self.assertEqual(response.headers["ETag"], '"5-rle"')
+        self.assertEqual(self.board_cache.get.call_count, 1)
+        name, derive, board = self.board_cache.get_derived.call_args[0]
+        self.assertEqual((name, board), ("rle", self.board))
+
+    def test_etag_of_other_format_gets_board(self):
+        response, body = self.get_board_bitmap(
+            "/api/place/board-bitmap", if_none_match='"5-rle"')
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(body, self.board)
+
+
+class BoardGenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = LoggedOutPlaceController.__new__(
+            LoggedOutPlaceController)
+        board_cache = MagicMock()
+        board_cache.peek.return_value = None
+        for target, name, value in (
+                (controllers, "BOARD_BITMAP_CACHE", board_cache),
+                (controllers, "baseplate_integration", MagicMock()),
+                (degraded, "is_degraded", MagicMock(return_value=False)),
+                (degraded.breakers["redis"], "record", MagicMock())):
+            patcher = patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.record = degraded.breakers["redis"].record
+
+    def test_generation_read_is_reported_to_breaker(self):
+        with patch.object(RedisCanvas, "get_generation", return_value=5):
+            self.assertEqual(self.controller._get_board_generation(), 5)
+
+        self.assertFalse(self.record.call_args[1]["failed"])
+
+    def test_failed_generation_read_is_reported_to_breaker(self):
+        with patch.object(
+                RedisCanvas, "get_generation", side_effect=RedisError):
+            self.assertIsNone(self.controller._get_board_generation())
+
+        self.assertTrue(self.record.call_args[1]["failed"])
+
+
+class GetBoardFormatTest(unittest.TestCase):
+    def get_board_format(self, url, headers):
+        request = Request.blank(url, headers=headers)
+        response = Response()
+        response.headers["Vary"] = "Origin"
+        with patch.object(controllers, "request", request), \
+                patch.object(controllers, "response", response):
+            board_format = controllers.get_board_format()
+        return response, board_format
+
+    def test_deflate_keeps_vary_origin(self):
+        response, board_format = self.get_board_format(
+            "/api/place/board-bitmap?format=deflate",
+            {"Accept-Encoding": "gzip, deflate"})
+
+        self.assertEqual(board_format, "deflate")
+        self.assertEqual(response.headers["Content-Encoding"], "deflate")
+        self.assertEqual(response.vary, ("Origin", "Accept-Encoding"))
+
+    def test_deflate_not_accepted(self):
+        response, board_format = self.get_board_format(
+            "/api/place/board-bitmap?format=deflate",
+            {"Accept-Encoding": "gzip"})
+
+        self.assertIsNone(board_format)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.vary, ("Origin", "Accept-Encoding"))
@@ -0,0 +1,101 @@
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+from reddit_place import lib
+from reddit_place.bench.fakes import fake_backends
+from reddit_place.models import BOARD_HEADER, RedisCanvas, RedisChangeLog
+
+
+class RestoreFromSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        backends = fake_backends()
+        self.fakes = backends.__enter__()
+        self.addCleanup(backends.__exit__, None, None, None)
+
+        self.snapshot_time = time.time() - 60
+        snapshot = MagicMock(
+            board=BOARD_HEADER.pack(int(self.snapshot_time), 2000000000) +
+            "\x10",
+            bitmap="\x10",
+            timestamp=self.snapshot_time,
+        )
+        patcher = patch.object(lib, "latest_snapshot")
+        patcher.start().get.return_value = snapshot
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(
+            lib, "_read_canvas_changes_since", return_value=[(2, 5)])
+        self.read_cass = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reset_change_log(self, at):
+        self.fakes["redis"].set(RedisChangeLog.HORIZON_KEY, at)
+
+    def restored_pixels(self):
+        bitmap = RedisCanvas.get_bitmap()
+        return [ord(bitmap[0]) >> 4, ord(bitmap[0]) & 15, ord(bitmap[1]) >> 4]
+
+    def test_replays_change_log(self):
+        self.reset_change_log(self.snapshot_time - 10)
+        RedisChangeLog.append([
+            (7, 0, 0, self.snapshot_time - 1),
+            (3, 1, 0, self.snapshot_time + 1),
+        ])
+
+        lib.restore_redis_board_from_snapshot(threads=1)
+
+        self.assertFalse(self.read_cass.called)
+        self.assertEqual(self.restored_pixels(), [1, 3, 0])
+
+    def test_lost_change_log_falls_back_to_cassandra(self):
+        # redis came back empty, with only what was placed since.
+        RedisChangeLog.append([(3, 1, 0, time.time())])
+
+        lib.restore_redis_board_from_snapshot(threads=1)
+
+        self.read_cass.assert_called_once_with(1, self.snapshot_time)
+        self.assertEqual(self.restored_pixels(), [1, 0, 5])
+
+    def test_change_log_newer_than_snapshot_falls_back_to_cassandra(self):
+        self.reset_change_log(self.snapshot_time - 10)
+        RedisChangeLog.append([(3, 1, 0, self.snapshot_time + 1)])
+
+        lib.restore_redis_board_from_snapshot(threads=1)
+
+        self.assertTrue(self.read_cass.called)
+
+    def test_resets_change_log(self):
+        self.reset_change_log(self.snapshot_time - 10)
+        RedisChangeLog.append([
+            (7, 0, 0, self.snapshot_time - 1),
+            (3, 1, 0, self.snapshot_time + 1),
+        ])
+
+        lib.restore_redis_board_from_snapshot(threads=1)
+
+        self.assertIsNone(RedisChangeLog.get_since(self.snapshot_time))
+        self.assertEqual(
+            RedisChangeLog.get_since(time.time() + 1), "")
+
+    def test_generation_is_past_snapshot(self):
+        self.reset_change_log(self.snapshot_time - 10)
+        RedisChangeLog.append([
+            (7, 0, 0, self.snapshot_time - 1),
+            (3, 1, 0, self.snapshot_time + 1),
+        ])
+
+        lib.restore_redis_board_from_snapshot(threads=1)
+
+        # one change was replayed, and then the board itself was set.
+        self.assertEqual(RedisCanvas.get_generation(), 2000000002)
+
+    def test_generation_is_past_lost_generation(self):
+        # redis came back with nothing, so it starts counting from 1.
+        RedisCanvas.set_bitmap("\x00")
+        self.assertEqual(RedisCanvas.get_generation(), 1)
+
+        lib.restore_redis_board_from_cass(threads=1)
+
+        self.assertGreater(RedisCanvas.get_generation(), time.time() - 60)
@@ -0,0 +1,130 @@
+import json
+import time
+import unittest
+
+from mock import patch
+from pylons import tmpl_context as c
+
+from reddit_place.bench.fakes import FakeUser, fake_backends
+from reddit_place.models import (
+    CANVAS_WIDTH,
+    Canvas,
+    get_wait_seconds,
+    Pixel,
+    PIXEL_COOLDOWN_SECONDS,
+    place_pixel,
+    RedisCanvas,
+    RedisChangeLog,
+    RedisCooldown,
+)
+
+
+class PixelPlaceTest(unittest.TestCase):
+    def setUp(self):
+        backends = fake_backends()
+        backends.__enter__()
+        self.addCleanup(backends.__exit__, None, None, None)
+
+        self.user = FakeUser(1)
+        # a placement long enough ago that the cooldown has passed.
+        RedisCooldown.set(self.user, 1)
+
+    def test_place_writes_to_cassandra(self):
+        with patch.object(Pixel, "queue_writes") as queue:
+            wait_seconds, generation = Pixel.place(self.user, 3, 10, 20, 300)
+
+        self.assertEqual(wait_seconds, 0)
+        self.assertEqual(generation, 1)
+        self.assertEqual(Canvas.get(10, 20)["color"], 3)
+        self.assertFalse(queue.called)
+
+    def test_place_queues_pixel_when_cassandra_write_fails(self):
+        with patch.object(Pixel, "write_pixels", side_effect=IOError), \
+                patch.object(Pixel, "queue_writes") as queue:
+            wait_seconds, generation = Pixel.place(self.user, 3, 10, 20, 300)
+
+        # the placement stands, so the controller still broadcasts it.
+        self.assertEqual(wait_seconds, 0)
+        self.assertEqual(generation, 1)
+        self.assertEqual(RedisCanvas.get_generation(), 1)
+        self.assertGreater(RedisCooldown.get(self.user), 1)
+
+        (pixels,), _ = queue.call_args
+        self.assertEqual(
+            [(pixel.color, pixel.x, pixel.y) for pixel in pixels],
+            [(3, 10, 20)],
+        )
+
+    def test_write_pixels_commits_pixel(self):
+        pixel = Pixel.create(self.user, 3, 10, 20)
+
+        self.assertFalse(pixel._dirty)
+        self.assertTrue(pixel._committed)
+        columns = Pixel._cf.get(pixel._id)
+        self.assertEqual(columns["color"], "3")
+        self.assertEqual(columns["x"], "10")
+        self.assertEqual(columns["user_name"], self.user.name)
+
+    def test_write_queued_pixel(self):
+        pixel = Pixel._new(self.user, 3, 10, 20)
+        queued = Pixel.from_queued_write(json.dumps({
+            "id": str(pixel._id),
+            "user_name": u"\u00e9",
+            "user_fullname": self.user._fullname,
+            "color": 3,
+            "x": 10,
+            "y": 20,
+        }))
+        Pixel.write_pixels([queued])
+
+        columns = Pixel._cf.get(pixel._id)
+        self.assertEqual(columns["user_name"], "\xc3\xa9")
+        self.assertEqual(columns["y"], "20")
+
+    def test_place_pixel_fills_in_missing_cooldown(self):
+        # nothing cached in redis for the user, and nothing in cassandra.
+        user = FakeUser(2)
+
+        wait_seconds, generation = place_pixel(user, 3, 10, 20)
+
+        self.assertEqual(wait_seconds, 0)
+        self.assertEqual(generation, 1)
+
+    def test_wait_seconds_after_placing(self):
+        place_pixel(self.user, 3, 10, 20)
+        c.place_memo = None
+
+        wait_seconds = get_wait_seconds(self.user)
+        self.assertAlmostEqual(wait_seconds, PIXEL_COOLDOWN_SECONDS, delta=5)
+
+
+class RedisChangeLogTest(unittest.TestCase):
+    def setUp(self):
+        backends = fake_backends()
+        self.fakes = backends.__enter__()
+        self.addCleanup(backends.__exit__, None, None, None)
+
+    def test_log_is_unknown_until_reset(self):
+        RedisChangeLog.append([(3, 10, 20, 100)])
+
+        self.assertIsNone(RedisChangeLog.get_since(50))
+
+    def test_changes_since_reset(self):
+        RedisChangeLog.reset()
+        now = time.time()
+        RedisChangeLog.append([(3, 10, 20, now), (4, 11, 20, now + 1)])
+
+        changes = RedisChangeLog.get_since(now + 1)
+        self.assertEqual(
+            list(RedisChangeLog.unpack(changes)),
+            [(20 * CANVAS_WIDTH + 11, 4)],
+        )
+        self.assertIsNone(RedisChangeLog.get_since(now - 60))
+
+    def test_log_lost_with_redis_is_unknown(self):
+        RedisChangeLog.reset()
+        RedisChangeLog.append([(3, 10, 20, time.time())])
+        self.fakes["redis"].strings.clear()
+        self.fakes["redis"].zsets.clear()
+
+        self.assertIsNone(RedisChangeLog.get_since(time.time() - 60))
@@ -0,0 +1,67 @@
+import unittest
+
+from mock import MagicMock, patch
+
+from reddit_place import stages
+
+
+class AttribSafeContext(object):
+    """Like r2's tmpl_context, which returns '' for unset attributes."""
+
+    def __getattr__(self, name):
+        return ""
+
+
+class StageTest(unittest.TestCase):
+    def setUp(self):
+        self.c = AttribSafeContext()
+        self.g = MagicMock()
+        self.g.live_config = {"place_stage_sample_rate": 0}
+        for name, value in (("c", self.c), ("g", self.g)):
+            patcher = patch.object(stages, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_admin_requests_get_debug_header(self):
+        self.c.user_is_admin = True
+        with stages.stage("redis_place"):
+            pass
+
+        response = MagicMock(headers={})
+        stages.add_debug_header(response)
+
+        self.assertTrue(self.g.stats.get_timer.called)
+        self.assertRegexpMatches(
+            response.headers[stages.DEBUG_HEADER], r"^redis_place=\d+\.\dms$")
+
+    def test_sampled_requests_are_timed(self):
+        self.g.live_config["place_stage_sample_rate"] = 1
+        with stages.stage("redis_place"):
+            pass
+
+        self.g.stats.get_timer.assert_called_once_with(
+            "place.stage.redis_place")
+
+        response = MagicMock(headers={})
+        stages.add_debug_header(response)
+        self.assertNotIn(stages.DEBUG_HEADER, response.headers)
+
+    def test_unsampled_requests_are_not_timed(self):
+        with stages.stage("redis_place"):
+            pass
+
+        self.assertFalse(self.g.stats.get_timer.called)
+
+    def test_reset_makes_a_new_decision(self):
+        with stages.stage("redis_place"):
+            pass
+
+        self.g.live_config["place_stage_sample_rate"] = 1
+        with stages.stage("redis_place"):
+            pass
+        self.assertFalse(self.g.stats.get_timer.called)
+
+        stages.reset()
+        with stages.stage("redis_place"):
+            pass
+        self.assertTrue(self.g.stats.get_timer.called)
@@ -0,0 +1,58 @@
+import time
+
+from pycassa.util import convert_uuid_to_time
+from pylons import app_globals as g
+
+from r2.lib import amqp
+
+from reddit_place import stages
+from reddit_place.models import PIXEL_BATCH_SIZE, PIXEL_WRITE_QUEUE, Pixel
+
+
+# How many times to try writing a batch before giving up on it and letting
+# the messages go back on the queue.
+MAX_WRITE_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+
+def process_pixel_writes():
+    """Write the pixels queued with place_write_behind on to cassandra.
+
+    Messages are only acked once their batch has been written.  Pixels are
+    written with their placement time as the column timestamp, so anything
+    delivered twice, or out of order, is harmless.
+
+    """
+
+    @g.stats.amqp_processor(PIXEL_WRITE_QUEUE)
+    def write_batch(msgs, chan):
+        stages.reset()
+
+        # redeliveries of the same pixel can land in one batch.
+        pixels = {}
+        for msg in msgs:
+            pixel = Pixel.from_queued_write(msg.body)
+            pixels[pixel._id] = pixel
+
+        for attempt in xrange(1, MAX_WRITE_ATTEMPTS + 1):
+            try:
+                Pixel.write_pixels(pixels.values())
+                break
+            except Exception:
+                if attempt == MAX_WRITE_ATTEMPTS:
+                    g.stats.simple_event("place.write_behind.failed")
+                    raise
+                g.stats.simple_event("place.write_behind.retry")
+                time.sleep(RETRY_DELAY * attempt)
+
+        # how far behind the placements cassandra is.
+        oldest = min(convert_uuid_to_time(pixel_id) for pixel_id in pixels)
+        lag = time.time() - oldest
+        g.stats.simple_timing("place.write_behind.lag", lag * 1000)
+        g.stats.simple_event("place.write_behind.pixels", delta=len(pixels))
+
+    amqp.handle_items(
+        PIXEL_WRITE_QUEUE,
+        write_batch,
+        limit=PIXEL_BATCH_SIZE,
+    )